@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the write path of download_asset against a local HTTP server.
+Compares the original loop (1 KiB chunks, flush after every chunk) with the streaming writer
+for several chunk sizes, with and without readinto.
+
+Usage: python benchmarks/bench_download_asset.py [size in MB] [repetitions]
+"""
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]/'src'))
+from downplanet.common import stream_to_file  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.end_headers()
+        self.wfile.write(self.server.data)
+
+
+def original(r, f):
+    # the loop used by download_asset before the streaming writer
+    written = 0
+    for chunk in r.iter_content(chunk_size=1024):
+        if chunk:
+            f.write(chunk)
+            f.flush()
+            written += len(chunk)
+    return written
+
+
+def run(url, out_file, write, repetitions):
+    best = 0
+    session = requests.Session()
+    for _ in range(repetitions):
+        start = perf_counter()
+        r = session.get(url, stream=True)
+        with open(out_file, 'wb') as f:
+            written = write(r, f)
+        r.close()
+        best = max(best, written / 2 ** 20 / (perf_counter() - start))
+    return best
+
+
+def main(size_mb=200, repetitions=3):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.data = bytes(range(256)) * (size_mb * 2 ** 20 // 256)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_port}/B08.tif'
+
+    cases = {'original (1 KiB + flush)': original}
+    for chunk_size in (2 ** 16, 2 ** 20, 2 ** 22):
+        for readinto in (False, True):
+            name = f'{chunk_size // 1024} KiB' + (' readinto' if readinto else '')
+            cases[name] = lambda r, f, c=chunk_size, ri=readinto: stream_to_file(r, f, chunk_size=c, readinto=ri)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'{size_mb} MB file, best of {repetitions}')
+        for name, write in cases.items():
+            print(f'{name:>26}: {run(url, Path(tmp)/"B08.tif", write, repetitions):8.1f} MB/s')
+
+    httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
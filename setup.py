@@ -2,7 +2,7 @@ from setuptools import find_packages, setup
 
 setup(
     name='downplanet',
-    extras_require=dict(tests=['pytest']),
+    extras_require={'tests': ['pytest'], 'async': ['aiohttp'], 'geo': ['shapely'], 'cog': ['rasterio']},
     packages=find_packages(where="src"),
     package_dir={"": "src"},
     install_requires=[
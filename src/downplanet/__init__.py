@@ -1,4 +1,8 @@
 from .planetary import DownPlanet
+from .aioplanet import AsyncDownPlanet
+from .common import DownloadError, ChecksumError
+from .cache import SearchCache
+from .index import SearchIndex
 
 version = '0.0.1'
 
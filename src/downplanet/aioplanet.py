@@ -0,0 +1,394 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from time import perf_counter
+from typing import Union
+
+import pystac
+from tqdm.auto import tqdm
+
+from .common import rm_tree, retry_delay, Manifest, probe_result, \
+    ChecksumError, expected_checksum, CHUNK_SIZE
+from .planetary import DownPlanet, _Progress, catalog_url
+
+try:
+    import aiohttp
+
+except ImportError:
+    aiohttp = None
+
+
+def run(coro):
+    """
+    Run a coroutine until it is complete and return its result.
+    Inside a running event loop (e.g., Jupyter), the coroutine is run in a new loop, in another thread.
+    """
+
+    try:
+        asyncio.get_running_loop()
+
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class AsyncDownPlanet(DownPlanet):
+    """
+    Downloader that runs the search paging, signing, HEAD probing and asset streaming on a single asyncio
+    event loop. The methods search and download_all can be called from scripts or notebooks, and the
+    coroutines search_async and download_all_async can be awaited from async code.
+    Requires aiohttp.
+    """
+
+    def __init__(self, catalog: str = catalog_url, logger_level=logging.INFO, max_connections: int = 64,
+                 **kwargs):
+        """
+        Create an asynchronous Sentinel 2 downloader for Microsoft Planetary Computer
+        :param catalog: STAC catalog to connect to. Defaults to "https://planetarycomputer.microsoft.com/api/stac/v1"
+        :param logger_level: verbosity Level.
+        :param max_connections: maximum number of simultaneous connections
+        :param kwargs: other arguments passed to DownPlanet
+        """
+
+        if aiohttp is None:
+            raise ImportError('AsyncDownPlanet requires aiohttp. Install it with: pip install downplanet[async]')
+
+        super().__init__(catalog=catalog, logger_level=logger_level, **kwargs)
+        self.max_connections = max_connections
+
+    def client_session(self):
+        """Create an aiohttp session limited to max_connections simultaneous connections."""
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections),
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60))
+
+    def search(self, geometry: Union[list, tuple], start_date: str, end_date: str = None, limit: int = 100,
+               **kwargs):
+        """Search for images. See search_async."""
+        return run(self.search_async(geometry, start_date, end_date=end_date, limit=limit, **kwargs))
+
+    async def search_async(self, geometry: Union[list, tuple], start_date: str, end_date: str = None,
+                           limit: int = 100, session=None, refresh: bool = False, query: dict = None,
+                           filter: Union[dict, str] = None, fields: Union[list, dict] = None,
+                           max_items: int = None, collections: Union[str, list] = None):
+        """
+        Search for images, following the pages of results of the STAC API. The results are stored in .search_df
+        If the downloader has a cache, it is used as in DownPlanet.iter_search.
+        :param geometry: Polygon in the format [(long1, lat1), (long2, lat2), ...] or Point (long, lat)
+        :param start_date: First date in the formats 'yyyy-mm-dd', 'yyyy-mm' or 'yyyy'
+        :param end_date: Last date. If end_date is None, the start_date will be expanded (see DownPlanet.search)
+        :param limit: number of items per page
+        :param session: aiohttp session. If None, a new one is created.
+        :param refresh: if True, ignore the cached search and ask the API for all the items again
+        :param query: filters on the properties, applied by the server. See DownPlanet.search.
+        :param filter: CQL2 filter applied by the server, as a dict (cql2-json) or a string (cql2-text)
+        :param fields: properties returned by the server, as a list (prefix '-' to exclude) or a dict
+        {'include': [...], 'exclude': [...]}
+        :param max_items: maximum number of items returned
+        :param collections: collection or list of collections to search. If None, the downloader's collections.
+        """
+
+        params = self._search_params(geometry, start_date, end_date=end_date, query=query, filter=filter,
+                                     fields=fields, max_items=max_items, collections=collections)
+
+        key = self.cache.key(params) if self.cache is not None else None
+        cached = self.cache.get(key) if key is not None and not refresh else None
+
+        if cached is not None and not cached['fresh'] and cached['last_updated'] is not None:
+            # ask just for the items updated after the last cached one, and merge them
+            query = {**params.get('query', {}), 'updated': {'gt': cached['last_updated']}}
+            new_items = await self._search_items(session, {**params, 'query': query}, limit)
+
+            self.logger.info(f'{len(new_items)} images updated since the cached search')
+            await asyncio.to_thread(self.cache.put, key, params, new_items, replace=False)
+            cached = dict(await asyncio.to_thread(self.cache.get, key), fresh=True)
+
+        if cached is not None and cached['fresh']:
+            self.logger.debug(f'Using cached search {key}')
+            items = cached['items']
+
+        else:
+            items = await self._search_items(session, params, limit)
+            if key is not None:
+                await asyncio.to_thread(self.cache.put, key, params, items)
+
+        self.search_df = self.items_df(items, properties=self.properties)
+
+        self.logger.info(f'{len(self.search_df)} images found. Access .search_df for the list.')
+
+    async def _search_items(self, session, params: dict, limit: int = 100) -> list:
+        """
+        Search the catalog, paging each collection at the same time.
+        :param params: parameters of the search (see DownPlanet._search_params)
+        :param limit: number of items per page
+        :return: list of items
+        """
+
+        max_items = params.get('max_items')
+        body = {'collections': params['collections'], 'datetime': params['datetime'],
+                'intersects': params['intersects'], 'limit': min(limit, max_items) if max_items else limit}
+
+        if params.get('query') is not None:
+            body['query'] = params['query']
+
+        filter = params.get('filter')
+        if filter is not None:
+            body.update({'filter': filter, 'filter-lang': 'cql2-text' if isinstance(filter, str) else 'cql2-json'})
+
+        fields = params.get('fields')
+        if isinstance(fields, (list, tuple)):
+            fields = {'include': [f for f in fields if not f.startswith('-')],
+                      'exclude': [f[1:] for f in fields if f.startswith('-')]}
+        if fields is not None:
+            body['fields'] = fields
+
+        async def collect(collection_body):
+            collected = []
+            async for page in self._pages(session, collection_body):
+                collected.extend(page)
+                if max_items and len(collected) >= max_items:
+                    break
+            return collected
+
+        # each collection is paged at the same time
+        async with nullcontext(session) if session is not None else self.client_session() as session:
+            results = await asyncio.gather(*[collect({**body, 'collections': [collection]})
+                                             for collection in params['collections']])
+
+        items = [item for collected in results for item in collected]
+        return items[:max_items] if max_items else items
+
+    async def _pages(self, session, body):
+        """Post a search to the STAC API and yield the items of each page, following the 'next' links."""
+
+        url, method = f'{self.catalog_url.rstrip("/")}/search', 'POST'
+
+        while url is not None:
+            async with session.request(method, url, json=body if method == 'POST' else None) as r:
+                r.raise_for_status()
+                # STAC APIs answer with application/geo+json
+                page = await r.json(content_type=None)
+
+            yield [pystac.Item.from_dict(feature) for feature in page.get('features', [])]
+
+            # the next page may be a GET (token in the href) or a POST (token in the body)
+            link = next((link for link in page.get('links', []) if link.get('rel') == 'next'), None)
+            url, method = (link['href'], link.get('method', 'GET')) if link is not None else (None, None)
+            if link is not None and 'body' in link:
+                body = {**body, **link['body']} if link.get('merge') else link['body']
+
+    def download_all(self, out_dir: Union[Path, str], show_pbar=True, retries=3, workers: int = 16, **kwargs):
+        """Download all the images that are in the search_df to the out_dir. See download_all_async."""
+        return run(self.download_all_async(out_dir, show_pbar=show_pbar, retries=retries, workers=workers,
+                                           **kwargs))
+
+    async def download_all_async(self, out_dir: Union[Path, str], show_pbar=True, retries=3, workers: int = 16,
+                                 **kwargs):
+        """
+        Download all the images that are in the search_df to the out_dir.
+        All the images and assets share the same connection pool, limited to max_connections.
+        :param out_dir: output directory
+        :param show_pbar: if True, show progress bars with the number of images and bytes downloaded
+        :param retries: number of retries for each asset
+        :param workers: number of images downloaded at the same time
+        :param kwargs: other arguments passed to download_item_async
+        :return: dataframe with one record per image (status, bytes, duration, retries, error).
+        It is also stored in .results_df
+        """
+
+        semaphore = asyncio.Semaphore(workers)
+
+        async with self.client_session() as session:
+            with tqdm(total=len(self.search_df), desc='All images', unit=' img', disable=not show_pbar) as images, \
+                    tqdm(unit_scale=True, unit='b', desc='Downloaded', smoothing=0, disable=not show_pbar) as pbar:
+
+                async def download(idx):
+                    async with semaphore:
+                        record = await self.download_item_async(self.get_item(idx), out_dir,
+                                                                session=session, pbar=pbar, retries=retries,
+                                                                **kwargs)
+                        images.update(1)
+                        return idx, record
+
+                records = dict(await asyncio.gather(*[download(idx) for idx in self.search_df.index]))
+
+        return self._set_results(records)
+
+    async def download_item_async(self, item, out_dir: Union[Path, str], session, pbar=None, retries: int = 3,
+                                  backoff_factor: float = 1., overwrite: bool = False,
+                                  chunk_size: int = CHUNK_SIZE, include=None, exclude=None, resolutions=None,
+                                  probe: bool = True, verify: bool = True):
+        """
+        Download a STAC item, with all its assets at the same time. See DownPlanet.download_item.
+        :param item: STAC item to download
+        :param out_dir: output directory
+        :param session: aiohttp session
+        :param pbar: progress bar updated with the bytes downloaded
+        :param verify: if True, check the checksum of the files and download them again if it does not match
+        :return: dictionary with status, bytes, duration, retries, error and failed assets {name: error}
+        """
+
+        record = dict(status='skipped', bytes=0, duration=0., retries=0, error=None, failed={})
+        start = perf_counter()
+
+        # check if there the output directory exists
+        out_dir = Path(out_dir)
+        if not out_dir.exists():
+            self.logger.warning(f'Output directory {str(out_dir)} does not exists. Create it first.')
+            return record
+
+        # create the output folder for the image
+        out_dir /= item.id + '.PC'
+        if out_dir.exists() and overwrite:
+            rm_tree(out_dir)
+        out_dir.mkdir(exist_ok=True)
+
+        manifest = Manifest(out_dir)
+
+        # keep just the selected assets
+        item = self.select_item_assets(item, include=include, exclude=exclude, resolutions=resolutions)
+
+        try:
+            # tokens are cached, so signing seldom goes to the network
+            signed_item = await asyncio.to_thread(self.tokens.sign_item, item)
+            await self._probe(session, signed_item, probe=probe)
+
+        except Exception as e:
+            self.logger.error(f'Problem signing {item.id}: {e}')
+            record.update(status='failed', error=str(e), duration=perf_counter() - start)
+            return record
+
+        names = list(signed_item.assets)
+        results = await asyncio.gather(*[self._download_asset_async(session, signed_item.assets[name], out_dir,
+                                                                    manifest=manifest, pbar=pbar, retries=retries,
+                                                                    backoff_factor=backoff_factor,
+                                                                    chunk_size=chunk_size, verify=verify)
+                                         for name in names], return_exceptions=True)
+
+        for asset_name, result in zip(names, results):
+            if isinstance(result, Exception):
+                self.logger.error(f'Problem downloading asset {asset_name}: {result}')
+                record['retries'] += getattr(result, 'retries', 0)
+                record['failed'][asset_name] = str(result)
+
+            else:
+                record['bytes'] += result[0]
+                record['retries'] += result[1]
+
+        if record['failed']:
+            record.update(status='failed',
+                          error=f'{len(record["failed"])} asset(s) of {item.id} failed: {", ".join(record["failed"])}')
+        else:
+            record['status'] = 'done'
+
+        record['duration'] = perf_counter() - start
+        return record
+
+    async def _probe(self, session, signed_item, probe=True):
+        """Set the .size and .etag of the assets of a signed item, as DownPlanet.sign_item does."""
+
+        async def head(asset):
+            href = asset.href.split('?')[0]
+            if href not in self.size_cache:
+                async with session.head(asset.href) as r:
+                    # a failed probe is not cached, the size remains unknown (see DownPlanet.sign_item)
+                    if not r.ok:
+                        self.logger.warning(f'Could not probe {asset.title}: HTTP {r.status}')
+                        return
+
+                    self.size_cache[href] = probe_result(r.headers)
+
+            asset.size, asset.etag, asset.md5 = self.size_cache[href]
+
+        to_probe = []
+        for asset in signed_item.assets.values():
+            asset.size, asset.etag, asset.md5 = asset.extra_fields.get('file:size'), None, None
+            if asset.size is None and probe:
+                to_probe.append(asset)
+
+        await asyncio.gather(*[head(asset) for asset in to_probe])
+
+        sizes = [asset.size for asset in signed_item.assets.values()]
+        signed_item.size = sum(sizes) if None not in sizes else None
+
+    async def _download_asset_async(self, session, asset, out_dir, manifest, pbar=None, retries: int = 3,
+                                    backoff_factor: float = 1., chunk_size: int = CHUNK_SIZE, verify: bool = True):
+        """
+        Download an asset with the same retry policy as DownPlanet.download_asset.
+        :return: tuple (number of bytes written, number of retries)
+        """
+
+        href, attempt = asset.href, 0
+        while True:
+            progress = _Progress(pbar)
+
+            try:
+                return await self._get_asset_async(session, asset, href, out_dir, manifest, pbar=progress,
+                                                   chunk_size=chunk_size, verify=verify), attempt
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, ChecksumError) as e:
+                progress.rollback()
+
+                response = isinstance(e, aiohttp.ClientResponseError)
+                status = e.status if response else None
+                delay = retry_delay(status, attempt, retries, backoff_factor=backoff_factor,
+                                    headers=e.headers if response and e.headers else None)
+
+                if delay is None:
+                    e.retries = attempt
+                    raise
+
+                attempt += 1
+
+                if status == 403:
+                    self.logger.warning(f'Access denied to {asset.title}. Renewing token ({attempt}/{retries})')
+                    href = await asyncio.to_thread(self.tokens.sign, href, True)
+
+                else:
+                    self.logger.warning(f'Problem downloading {asset.title}: {e!r}. '
+                                        f'Retrying in {delay:.1f}s ({attempt}/{retries})')
+                    await asyncio.sleep(delay)
+
+    async def _get_asset_async(self, session, asset, href, out_dir, manifest, pbar=None,
+                               chunk_size: int = CHUNK_SIZE, verify: bool = True):
+        """
+        Make one attempt to download an asset, resuming a previous .part file when possible.
+        The size and checksum of the file are checked as in DownPlanet._get_asset.
+        """
+
+        state = self._asset_state(asset, out_dir, manifest)
+
+        if state['complete']:
+            if pbar is not None:
+                pbar.update(state['size'])
+            return 0
+
+        offset, etag, written, hasher = state['offset'], state['etag'], 0, None
+        expected = expected_checksum(asset) if verify else None
+
+        if offset and offset == state['size']:
+            etag, hasher = self._complete_part(state, etag, expected, pbar)
+
+        else:
+            async with session.get(href, headers=state['headers']) as r:
+                r.raise_for_status()
+
+                offset, etag, expected, hasher = self._start_stream(asset, state, manifest, r.status, r.headers,
+                                                                    offset, etag, expected, verify, pbar)
+
+                with open(state['part_path'].as_posix(), 'ab' if offset else 'wb') as f:
+                    async for chunk in r.content.iter_chunked(chunk_size):
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        written += len(chunk)
+                        if pbar is not None:
+                            pbar.update(len(chunk))
+
+                self._check_length(asset, r.headers, written, aiohttp.ClientPayloadError)
+
+        self._end_asset(asset, state, manifest, offset, written, etag, expected, hasher, aiohttp.ClientPayloadError)
+        return written
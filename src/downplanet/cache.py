@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Union
+
+import pystac
+
+
+def _round_coords(obj, digits=7):
+    """Round the coordinates of a geometry, so equivalent geometries produce the same key."""
+    if isinstance(obj, float):
+        return round(obj, digits)
+    if isinstance(obj, (list, tuple)):
+        return [_round_coords(value, digits) for value in obj]
+    if isinstance(obj, dict):
+        return {key: _round_coords(value, digits) for key, value in obj.items()}
+    return obj
+
+
+class SearchCache:
+    """
+    Persistent cache of STAC searches in a SQLite database.
+    The searches are keyed by their parameters (collections, normalized geometry, datetime range, query...).
+    Each search keeps the time it was fetched and the latest `updated` property of its items, so an expired
+    search can be refreshed by asking only for the items updated after that.
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: float = 24 * 3600):
+        """
+        :param path: SQLite file. It is created if it does not exist.
+        :param ttl: time (in seconds) during which a cached search is used without asking the API
+        """
+
+        self.path = Path(path)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS searches '
+                         '(key TEXT PRIMARY KEY, params TEXT, fetched REAL, last_updated TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS items '
+                         '(key TEXT, id TEXT, updated TEXT, item TEXT, PRIMARY KEY (key, id))')
+
+    @contextmanager
+    def _connect(self):
+        # commit and close the connection at the end of each operation
+        conn = sqlite3.connect(self.path.as_posix(), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(params: dict) -> str:
+        """
+        Create the key of a search.
+        :param params: parameters of the search. The page size ('limit') is not part of the key.
+        :return: hash of the normalized parameters
+        """
+
+        params = {name: value for name, value in params.items() if name != 'limit' and value is not None}
+        normalized = json.dumps(_round_coords(params), sort_keys=True, default=str)
+        return hashlib.sha1(normalized.encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Get a cached search.
+        :param key: key of the search
+        :return: dictionary with the list of items, the time it was fetched, whether it is still fresh (ttl)
+        and the latest `updated` of its items. None if the search is not in the cache.
+        """
+
+        with self.lock, self._connect() as conn:
+            row = conn.execute('SELECT fetched, last_updated FROM searches WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            items = [pystac.Item.from_dict(json.loads(item)) for item, in
+                     conn.execute('SELECT item FROM items WHERE key = ? ORDER BY rowid', (key,))]
+
+        fetched, last_updated = row
+        return dict(items=items, fetched=fetched, fresh=time() - fetched < self.ttl, last_updated=last_updated)
+
+    def put(self, key: str, params: dict, items: list, replace: bool = True):
+        """
+        Store the items of a search.
+        :param key: key of the search
+        :param params: parameters of the search, kept for reference
+        :param items: list of STAC items
+        :param replace: if True, the items previously cached for this search are removed. Otherwise, the new
+        items are merged with them (items with the same id are updated).
+        """
+
+        with self.lock, self._connect() as conn:
+            if replace:
+                conn.execute('DELETE FROM items WHERE key = ?', (key,))
+
+            conn.executemany('INSERT OR REPLACE INTO items (key, id, updated, item) VALUES (?, ?, ?, ?)',
+                             [(key, item.id, item.properties.get('updated'), json.dumps(item.to_dict()))
+                              for item in items])
+
+            last_updated, = conn.execute('SELECT MAX(updated) FROM items WHERE key = ?', (key,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO searches (key, params, fetched, last_updated) VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(params, default=str), time(), last_updated))
+
+    def clear(self):
+        """Remove all the searches from the cache."""
+        with self.lock, self._connect() as conn:
+            conn.execute('DELETE FROM items')
+            conn.execute('DELETE FROM searches')
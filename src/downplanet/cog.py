@@ -0,0 +1,88 @@
+import math
+import os
+from pathlib import Path
+from urllib.parse import urlparse
+
+try:
+    import rasterio
+    from rasterio.errors import RasterioIOError
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import Window, from_bounds, intersect
+
+except ImportError:
+    rasterio = None
+
+# GDAL options to read COGs over http: no listing of the remote folder, consecutive ranges merged in a
+# single request and a cache of the blocks already read
+gdal_env = dict(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR', GDAL_HTTP_MERGE_CONSECUTIVE_RANGES='YES',
+                GDAL_HTTP_MULTIPLEX='YES', VSI_CACHE='TRUE',
+                CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif,.tiff,.TIF,.TIFF')
+
+
+# check if an asset is a GeoTIFF (COG), by its media type or by the extension of its href
+def is_cog(asset):
+    if asset.media_type is not None:
+        return 'image/tiff' in asset.media_type
+    return Path(urlparse(asset.href).path).suffix.lower() in ('.tif', '.tiff')
+
+
+def read_window(href: str, out_path, bounds: tuple = None, crs: str = 'EPSG:4326', overview: int = None) -> int:
+    """
+    Read just the part of a COG that covers the bounds, or one of its overviews, and write it to a GeoTIFF.
+    GDAL reads the header and the internal tiles that are needed with HTTP range requests, so only a fraction
+    of the file is transferred.
+    :param href: (signed) href of the COG
+    :param out_path: path of the GeoTIFF to write. It is written to a .part file first.
+    :param bounds: (min x, min y, max x, max y) of the area of interest. If None, the whole image is read.
+    :param crs: CRS of the bounds. Defaults to lon/lat.
+    :param overview: overview level to read (0 is the first overview, half the resolution for Sentinel 2
+    COGs). It is limited to the coarsest overview of the file. If None, the full resolution is read.
+    :return: number of bytes written
+    """
+
+    if rasterio is None:
+        raise ImportError('Reading windows of COGs requires rasterio. Install it with: pip install downplanet[cog]')
+
+    with rasterio.Env(**gdal_env):
+        if overview is None:
+            with rasterio.open(href) as src:
+                return _write_window(src, out_path, bounds, crs)
+
+        # the levels that the file does not have fail to open, so the next coarsest available is used
+        for level in range(overview, -2, -1):
+            try:
+                with rasterio.open(href, overview_level=level if level >= 0 else None) as src:
+                    return _write_window(src, out_path, bounds, crs)
+
+            except RasterioIOError as e:
+                if level < 0 or 'overview level' not in str(e):
+                    raise
+
+
+# write the part of an open dataset that covers the bounds (or the whole dataset) to a GeoTIFF
+def _write_window(src, out_path, bounds, crs):
+    out_path = Path(out_path)
+    part_path = out_path.with_name(out_path.name + '.part')
+    window = Window(0, 0, src.width, src.height)
+
+    if bounds is not None:
+        # window (in whole pixels) that covers the bounds, in the CRS of the COG
+        window = from_bounds(*transform_bounds(crs, src.crs, *bounds), transform=src.transform)
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        window = Window(col_off, row_off, math.ceil(window.col_off + window.width) - col_off,
+                        math.ceil(window.row_off + window.height) - row_off)
+
+        # keep the window inside the image
+        full = Window(0, 0, src.width, src.height)
+        if not intersect(window, full):
+            raise ValueError(f'The area of interest does not intersect {Path(src.name).name}')
+        window = window.intersection(full)
+
+    profile = dict(src.profile, driver='GTiff', width=window.width, height=window.height,
+                   transform=src.window_transform(window))
+
+    with rasterio.open(part_path, 'w', **profile) as dst:
+        dst.write(src.read(window=window))
+
+    os.replace(part_path, out_path)
+    return out_path.stat().st_size
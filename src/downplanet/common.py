@@ -1,10 +1,26 @@
 from geojson import Point, Polygon
 from pathlib import Path
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import base64
+import threading
+import json
+import os
+from fnmatch import fnmatch
 
+import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+# default size of the chunks read from the connection and written to disk
+CHUNK_SIZE = 2 ** 20
+
+# pandas >= 2 infers a single format for the whole column unless told the strings are ISO 8601 (which may mix
+# dates with and without fractions of seconds). Older versions have no 'ISO8601' format, but parse them anyway
+iso8601 = dict(format='ISO8601') if int(pd.__version__.split('.')[0]) >= 2 else {}
+
 
 def create_geometry(pts, logger=None):
     if isinstance(pts, tuple):
@@ -33,6 +49,23 @@ def create_geometry(pts, logger=None):
             print(msg)
 
 
+class DownloadError(Exception):
+    """Raised when one or more assets of an item could not be downloaded."""
+
+    def __init__(self, msg, failed=None):
+        super().__init__(msg)
+        # dictionary {asset_name: error message} with the assets that failed
+        self.failed = failed if failed is not None else {}
+
+
+class ChecksumError(DownloadError):
+    """Raised when the checksum of a downloaded file does not match the expected one."""
+
+
+class RangesNotSupported(DownloadError):
+    """Raised when the server answers a Range request with the whole file."""
+
+
 # remove the folder
 def rm_tree(pth):
     pth = Path(pth)
@@ -50,6 +83,8 @@ def requests_retry_session(
     backoff_factor=0.3,
     status_forcelist=(500, 502, 504),
     session=None,
+    pool_connections=10,
+    pool_maxsize=10,
 ):
     session = session or requests.Session()
     retry = Retry(
@@ -59,7 +94,249 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    # pool_connections is the number of hosts kept in the pool and pool_maxsize the number of connections per host.
+    # pool_maxsize must be at least the number of threads sharing the session
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
+
+
+# delay before a new attempt: exponential backoff with full jitter
+def backoff_delay(attempt, backoff_factor=1., max_delay=60., retry_after=None):
+    delay = random.uniform(0, min(max_delay, backoff_factor * 2 ** (attempt - 1)))
+
+    # the server may ask to wait for some time before trying again
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+def retry_delay(status, attempt: int, retries: int, backoff_factor: float = 1., headers=None, statuses=None):
+    """
+    Decide if a failed request is retried, and when. This is the retry policy of all the downloads.
+    :param status: HTTP status of the failure, or None for broken connections, timeouts and checksum errors
+    :param attempt: number of retries already made
+    :param retries: maximum number of retries
+    :param backoff_factor: base delay (in seconds) of the exponential backoff
+    :param headers: headers of the failed response, whose Retry-After is honored
+    :param statuses: statuses that are retried. Defaults to expired tokens (403), throttling (429) and server
+    errors (5xx)
+    :return: delay (in seconds) before the next attempt, or None if the request must not be retried.
+    A 403 is retried at once (0), after the token is renewed.
+    """
+
+    retryable = status is None or (status in (403, 429) or status >= 500 if statuses is None else status in statuses)
+    if not retryable or attempt >= retries:
+        return None
+
+    if status == 403:
+        return 0.
+
+    retry_after = parse_retry_after(headers.get('Retry-After')) if headers is not None else None
+    return backoff_delay(attempt + 1, backoff_factor=backoff_factor, retry_after=retry_after)
+
+
+# parse the Retry-After header (seconds or http date) into seconds
+def parse_retry_after(value):
+    if value is None:
+        return None
+
+    try:
+        return max(0., float(value))
+
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+            return max(0., (date - datetime.now(timezone.utc)).total_seconds())
+
+        except (TypeError, ValueError):
+            return None
+
+
+class Manifest:
+    """
+    Keep track of the files downloaded to a folder (size, ETag, ...) in a json file.
+    It is shared by the threads downloading the assets of the same item.
+    """
+
+    file_name = '.downplanet.json'
+
+    def __init__(self, folder):
+        self.path = Path(folder)/self.file_name
+        self.lock = threading.Lock()
+
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.entries.get(name, {}))
+
+    def update(self, name, **fields):
+        with self.lock:
+            self.entries.setdefault(name, {}).update(fields)
+
+            # write to a temporary file first, so the manifest is never left truncated
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(self.entries, indent=2))
+            os.replace(tmp, self.path)
+
+
+# write the body of a streamed response to an open file and return the number of bytes written
+# If a hasher is given, it is updated with every chunk written
+def stream_to_file(r, f, chunk_size=CHUNK_SIZE, readinto=False, pbar=None, hasher=None):
+    written = 0
+
+    if readinto:
+        # read the raw stream into a preallocated buffer, that is reused for every chunk
+        r.raw.decode_content = True
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            n = r.raw.readinto(buffer)
+            if not n:
+                break
+            f.write(buffer[:n])
+            if hasher is not None:
+                hasher.update(buffer[:n])
+            written += n
+            if pbar is not None:
+                pbar.update(n)
+
+    else:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                written += len(chunk)
+                if pbar is not None:
+                    pbar.update(len(chunk))
+
+    return written
+
+
+# update a hasher with the content of a file (or its first `limit` bytes) and return it
+def hash_file(path, hasher, limit=None, chunk_size=CHUNK_SIZE):
+    remaining = limit if limit is not None else float('inf')
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(int(min(chunk_size, remaining)))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+# multihash prefixes (code and length, in hex) of the algorithms used in the file:checksum field of STAC
+multihash_prefixes = {'d50110': 'md5', '1114': 'sha1', '1220': 'sha256', '1340': 'sha512'}
+
+
+def expected_checksum(asset, headers=None):
+    """
+    Find the checksum that a downloaded asset must have.
+    :param asset: STAC asset. Its `file:checksum` (multihash) is used first, then the .md5 probed by sign_item.
+    :param headers: headers of the response. Its Content-MD5 or x-ms-blob-content-md5 (base64) is used if the
+    asset has no checksum. Content-MD5 must refer to the whole file (not to a range).
+    :return: tuple (algorithm, hex digest), or None if unknown
+    """
+
+    checksum = asset.extra_fields.get('file:checksum')
+    if checksum:
+        for prefix, algorithm in multihash_prefixes.items():
+            if checksum.lower().startswith(prefix):
+                return algorithm, checksum[len(prefix):].lower()
+
+    md5 = getattr(asset, 'md5', None) or (header_md5(headers) if headers is not None else None)
+    return ('md5', md5) if md5 else None
+
+
+# size, ETag and MD5 of a file, as informed by the headers of a HEAD request (None if unknown)
+def probe_result(headers):
+    length = headers.get('content-length')
+    return int(length) if length is not None else None, headers.get('ETag'), header_md5(headers)
+
+
+# MD5 (hex) informed by the server in the Content-MD5 or x-ms-blob-content-md5 (Azure) headers
+def header_md5(headers):
+    value = headers.get('x-ms-blob-content-md5') or headers.get('Content-MD5')
+    try:
+        return base64.b64decode(value).hex() if value else None
+    except ValueError:
+        return None
+
+
+# check if an asset matches any of the patterns (glob) by its key, media type or roles
+def match_asset(key, asset, patterns):
+    names = [key, asset.media_type] + list(asset.roles or [])
+    return any(fnmatch(str(name), pattern) for pattern in patterns for name in names if name is not None)
+
+
+def select_assets(assets, include=None, exclude=None, resolutions=None):
+    """
+    Select the assets by key, media type, role and resolution.
+    :param assets: dictionary {key: asset}
+    :param include: pattern or list of patterns (glob) of the assets to keep, e.g. ['B04', 'B08', '*metadata*']
+    :param exclude: pattern or list of patterns of the assets to drop, e.g. ['preview', 'image/png']
+    :param resolutions: resolution or list of resolutions (gsd in meters) of the bands to keep, e.g. [10, 20]
+    :return: dictionary with the selected assets. If neither include nor resolutions are given, all the assets
+    are selected (except the excluded ones). Otherwise, the assets that match any of them are selected.
+    """
+
+    include = [include] if isinstance(include, str) else include
+    exclude = [exclude] if isinstance(exclude, str) else exclude
+    resolutions = [resolutions] if isinstance(resolutions, (int, float)) else resolutions
+
+    selected = {}
+    for key, asset in assets.items():
+        if include or resolutions:
+            by_name = include is not None and match_asset(key, asset, include)
+            by_resolution = resolutions is not None and asset.extra_fields.get('gsd') in resolutions
+            if not (by_name or by_resolution):
+                continue
+
+        if exclude and match_asset(key, asset, exclude):
+            continue
+
+        selected[key] = asset
+
+    return selected
+
+
+def compact_df(df, max_categories=0.5):
+    """
+    Give compact types to the columns of a dataframe of STAC properties (inplace).
+    Dates ('datetime', 'created', 'updated'...) become datetime64, floats become float32 and the strings that
+    repeat (tile, platform, processing baseline...) become categories. Other columns (lists, dicts) are kept.
+    :param df: dataframe with one property per column
+    :param max_categories: strings are turned into categories if the number of distinct values is at most
+    this fraction of the number of values
+    :return: the dataframe
+    """
+
+    for column in df.columns:
+        values = df[column]
+
+        if values.dtype == 'float64':
+            df[column] = values.astype('float32')
+            continue
+
+        if isinstance(values.dtype, pd.CategoricalDtype) or not pd.api.types.is_object_dtype(values) and \
+                not pd.api.types.is_string_dtype(values):
+            continue
+
+        strings = values.dropna()
+        if not len(strings) or not all(isinstance(value, str) for value in strings):
+            continue
+
+        if column in ('created', 'updated') or str(column).endswith('datetime'):
+            df[column] = pd.to_datetime(values, utc=True, errors='coerce', **iso8601)
+
+        elif strings.nunique() <= max_categories * len(strings):
+            df[column] = values.astype('category')
+
+    return df
@@ -0,0 +1,277 @@
+import json
+import re
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pystac
+
+from .common import create_geometry, iso8601
+
+try:
+    import shapely
+    from shapely.geometry import shape
+
+except ImportError:
+    shapely = None
+
+# MGRS tile in the ids of the Sentinel 2 items, e.g. S2A_MSIL2A_20210101T132231_R038_T22KGA_20210102T000000
+tile_pattern = re.compile(r'_T(\d{2}[A-Z]{3})_')
+
+# processing (generation) time at the end of the ids of the Sentinel 2 items
+generation_pattern = re.compile(r'_(\d{8}T\d{6})$')
+
+
+# geojson dictionary of a geometry given as geojson, object with __geo_interface__ or points (see create_geometry)
+def as_geojson(geometry):
+    if hasattr(geometry, '__geo_interface__'):
+        geometry = geometry.__geo_interface__
+
+    if not isinstance(geometry, dict):
+        geometry = create_geometry(list(geometry) if isinstance(geometry, list) else geometry)
+
+    return geometry
+
+
+# bounds (min long, min lat, max long, max lat) of a geojson geometry or a list of points (see create_geometry)
+def geometry_bounds(geometry):
+    geometry = as_geojson(geometry)
+    coords = np.array(_flatten(geometry['coordinates']), dtype='float64').reshape(-1, 2)
+    return tuple(coords.min(axis=0).tolist() + coords.max(axis=0).tolist())
+
+
+# group the bounds of several AOIs into clusters whose bounds are at most max_size (degrees) wide and tall.
+# Returns a list of (bounds of the cluster, positions of its AOIs)
+def cluster_bounds(bounds, max_size=1.):
+    clusters = []
+    for position in sorted(range(len(bounds)), key=lambda i: (bounds[i][0], bounds[i][1])):
+        x_min, y_min, x_max, y_max = bounds[position]
+
+        for cluster in clusters:
+            merged = (min(cluster[0][0], x_min), min(cluster[0][1], y_min),
+                      max(cluster[0][2], x_max), max(cluster[0][3], y_max))
+            if merged[2] - merged[0] <= max_size and merged[3] - merged[1] <= max_size:
+                cluster[0] = merged
+                cluster[1].append(position)
+                break
+        else:
+            clusters.append([(x_min, y_min, x_max, y_max), [position]])
+
+    return [(tuple(box), positions) for box, positions in clusters]
+
+
+# flatten the nested coordinates of a geometry into a list of numbers
+def _flatten(coords):
+    if isinstance(coords, (int, float)):
+        return [coords]
+    return [value for coord in coords for value in _flatten(coord)]
+
+
+# bbox of an item of the search_df (serialized as JSON or pystac.Item)
+def _item_bbox(value):
+    bbox = value.bbox if isinstance(value, pystac.Item) else json.loads(value).get('bbox')
+    return bbox[:2] + bbox[-2:] if bbox else [np.nan] * 4
+
+
+class SearchIndex:
+    """
+    Spatial and temporal index over the results of a search (search_df).
+    The bboxes of the items are kept in a numpy array, the datetimes are sorted and the items are grouped by
+    tile, so the selections are vectorized instead of looping over the items. The spatial selections test the
+    bboxes of the items, not their exact footprints.
+    """
+
+    def __init__(self, df: pd.DataFrame, tile_column: str = 's2:mgrs_tile', cloud_column: str = 'eo:cloud_cover',
+                 baseline_column: str = 's2:processing_baseline'):
+        """
+        :param df: dataframe of items (see DownPlanet.items_df)
+        :param tile_column: property with the tile of the items. If it is not in the df, the MGRS tile is taken
+        from the ids of the items.
+        :param cloud_column: property with the cloud cover of the items
+        :param baseline_column: property with the processing baseline of the items, used by deduplicate
+        """
+
+        self.df = df
+
+        # bboxes of the items (n x 4), NaN for the items without bbox
+        self.bboxes = np.array([_item_bbox(value) for value in df['item']], dtype='float64').reshape(-1, 4)
+
+        # datetimes in ns and the positions of the items with datetime, sorted by datetime
+        times = pd.to_datetime(df['datetime'], utc=True, **iso8601) if 'datetime' in df else \
+            pd.Series(pd.NaT, index=df.index)
+        valid = np.flatnonzero(times.notna().to_numpy())
+        self.times = times.values.astype('datetime64[ns]').astype('int64')
+        self.order = valid[np.argsort(self.times[valid], kind='stable')]
+        self.sorted_times = self.times[self.order]
+
+        # tile of each item, as category codes
+        tiles = df[tile_column] if tile_column in df else \
+            pd.Series([(m.group(1) if m else None) for m in map(tile_pattern.search, df.index)], index=df.index)
+        self.tiles = pd.Categorical(tiles)
+
+        # collection of each item, as category codes (-1 if unknown)
+        self.collections = pd.Categorical(df['collection']).codes.astype('int64') if 'collection' in df else \
+            np.full(len(df), -1)
+
+        self.clouds = df[cloud_column].to_numpy(dtype='float64', na_value=np.nan) if cloud_column in df else \
+            np.full(len(df), np.nan)
+
+        self.baseline_column = baseline_column
+
+    def __len__(self):
+        return len(self.df)
+
+    def covering(self, aoi, contains: bool = False, exact: bool = False) -> pd.DataFrame:
+        """
+        Select the items whose bbox intersects (or contains) an area of interest.
+        :param aoi: geojson geometry, object with __geo_interface__ or points as in DownPlanet.search
+        :param contains: if True, select only the items whose bbox contains the whole aoi
+        :param exact: if True, the items selected by their bbox are tested against their footprints (geometry),
+        so the items whose bbox overlaps the aoi but not their footprint are dropped. Requires shapely.
+        :return: dataframe with the selected items
+        """
+
+        x_min, y_min, x_max, y_max = geometry_bounds(aoi)
+        b = self.bboxes
+
+        if contains:
+            mask = (b[:, 0] <= x_min) & (b[:, 1] <= y_min) & (b[:, 2] >= x_max) & (b[:, 3] >= y_max)
+        else:
+            mask = (b[:, 0] <= x_max) & (b[:, 1] <= y_max) & (b[:, 2] >= x_min) & (b[:, 3] >= y_min)
+
+        if exact:
+            positions = np.flatnonzero(mask)
+            mask[positions] = self._footprints_match(positions, aoi, contains)
+
+        return self.df[mask]
+
+    def between(self, start: str, end: str) -> pd.DataFrame:
+        """
+        Select the items sensed between two dates (inclusive), sorted by datetime.
+        :param start: first date, e.g. '2021-01-01'
+        :param end: last date
+        :return: dataframe with the selected items
+        """
+
+        first = np.searchsorted(self.sorted_times, self._ns(start), side='left')
+        last = np.searchsorted(self.sorted_times, self._ns(end), side='right')
+        return self.df.iloc[self.order[first:last]]
+
+    def nearest_in_time(self, date: str, n: int = 1) -> pd.DataFrame:
+        """
+        Select the items sensed closest to a date.
+        :param date: reference date, e.g. '2021-06-15'
+        :param n: number of items
+        :return: dataframe with the n closest items, the closest first
+        """
+
+        # the n closest items are among the n items before and the n items after the date
+        position = np.searchsorted(self.sorted_times, self._ns(date))
+        candidates = self.order[max(position - n, 0):position + n]
+
+        distance = np.abs(self.times[candidates] - self._ns(date))
+        return self.df.iloc[candidates[np.argsort(distance, kind='stable')[:n]]]
+
+    def best_per_tile(self, max_cloud: float = None, n: int = 1) -> pd.DataFrame:
+        """
+        Select the least cloudy items of each tile (e.g. to build a mosaic).
+        :param max_cloud: if given, drop the items with more cloud cover than that
+        :param n: number of items per tile
+        :return: dataframe with the selected items, sorted by tile and cloud cover
+        """
+
+        codes = self.tiles.codes
+        candidates = np.arange(len(self.df))
+        if max_cloud is not None:
+            candidates = candidates[self.clouds <= max_cloud]
+
+        # sort by tile and cloud cover (NaN last) and take the first n of each tile
+        candidates = candidates[np.lexsort((self.clouds[candidates], codes[candidates]))]
+        tile_codes = codes[candidates]
+        starts = np.searchsorted(tile_codes, tile_codes, side='left')
+        rank = np.arange(len(candidates)) - starts
+
+        return self.df.iloc[candidates[rank < n]]
+
+    def deduplicate(self, covered: bool = False) -> pd.DataFrame:
+        """
+        Drop the items that repeat the same acquisition: for each tile and sensing datetime, keep the item with
+        the newest processing baseline (then the newest processing time, taken from the id).
+        :param covered: if True, also drop the items whose footprint is fully covered by the footprint of another
+        item of the same collection sensed on the same day (e.g. the partial tiles at the edges of an orbit).
+        Requires shapely.
+        :return: dataframe with the remaining items, in the original order
+        """
+
+        keys = pd.DataFrame({
+            'tile': self.tiles.codes.astype('int64'), 'time': self.times,
+            'baseline': self.df[self.baseline_column].astype(object).fillna('').astype(str).to_numpy()
+            if self.baseline_column in self.df else '',
+            'generation': [(m.group(1) if m else '') for m in map(generation_pattern.search, self.df.index)]
+        })
+
+        # the items without tile or datetime are never considered duplicates
+        unknown = ((keys['tile'] < 0) | ~np.isin(np.arange(len(keys)), self.order)).to_numpy()
+        keys.loc[unknown, 'tile'] = -1 - np.flatnonzero(unknown)
+
+        newest = keys.sort_values(['baseline', 'generation'], ascending=False, kind='stable')
+        keep = np.sort(newest.drop_duplicates(['tile', 'time']).index.to_numpy())
+
+        if covered:
+            keep = keep[~self._covered(keep)]
+
+        return self.df.iloc[keep]
+
+    def _footprints(self, positions: np.ndarray) -> np.ndarray:
+        """Footprints (shapely geometries, None if unknown) of the items (positions)."""
+        geometries = [json.loads(value).get('geometry') if isinstance(value, str) else value.geometry
+                      for value in self.df['item'].iloc[positions]]
+        return np.array([shape(geometry) if geometry else None for geometry in geometries], dtype=object)
+
+    def _footprints_match(self, positions: np.ndarray, aoi, contains: bool = False) -> np.ndarray:
+        """Check which of the items (positions) have the footprint intersecting (or containing) the aoi."""
+
+        if shapely is None:
+            raise ImportError('Testing the footprints requires shapely. Install it with: pip install downplanet[geo]')
+
+        footprints = self._footprints(positions)
+        aoi = shape(as_geojson(aoi))
+
+        # the items without footprint are kept, as they were selected by their bbox
+        return np.array([footprint is None or (footprint.contains(aoi) if contains else footprint.intersects(aoi))
+                         for footprint in footprints], dtype=bool)
+
+    def _covered(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Check which of the items (positions) have the footprint covered by another item of the same collection
+        and day.
+        """
+
+        if shapely is None:
+            raise ImportError('Dropping the covered items requires shapely. '
+                              'Install it with: pip install downplanet[geo]')
+
+        geometries = self._footprints(positions)
+        days = self.times[positions] // (24 * 3600 * 10 ** 9)
+        collections = self.collections[positions]
+
+        # pairs (i, j) where the footprint of i is covered by the footprint of j
+        tree = shapely.STRtree(geometries)
+        i, j = tree.query(geometries, predicate='covered_by')
+        same = (i != j) & (days[i] == days[j]) & (collections[i] == collections[j])
+        i, j = i[same], j[same]
+
+        # when two footprints cover each other (identical), just the second one is dropped
+        mutual = set(zip(j.tolist(), i.tolist()))
+        covered = np.zeros(len(positions), dtype=bool)
+        for a, b in zip(i.tolist(), j.tolist()):
+            if (a, b) not in mutual or a > b:
+                covered[a] = True
+
+        return covered
+
+    @staticmethod
+    def _ns(date: Union[str, pd.Timestamp]) -> int:
+        # date as ns since the epoch. Dates without timezone are taken as UTC
+        date = pd.Timestamp(date)
+        return (date.tz_localize('UTC') if date.tzinfo is None else date).value
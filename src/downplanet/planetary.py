@@ -3,25 +3,74 @@ import logging
 from typing import Union
 from pathlib import Path
 import pandas as pd
-from .common import create_geometry, rm_tree, requests_retry_session
+from .tokens import TokenCache
+from .cache import SearchCache
+from .index import SearchIndex, geometry_bounds, cluster_bounds, shapely
+from .cog import is_cog, read_window
+from .common import create_geometry, rm_tree, requests_retry_session, DownloadError, retry_delay, \
+    Manifest, stream_to_file, select_assets, match_asset, compact_df, ChecksumError, RangesNotSupported, \
+    expected_checksum, probe_result, hash_file, CHUNK_SIZE
 import planetary_computer as pc
 import requests
-from time import sleep
+from time import sleep, perf_counter
+import threading
+import os
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import queue
+import json
+import re
+import hashlib
+import pystac
 
 from urllib.parse import urlparse
-from tqdm.notebook import tqdm
+from tqdm.auto import tqdm
 
 catalog_url = "https://planetarycomputer.microsoft.com/api/stac/v1"
 s2_collection = 'sentinel-2-l2a'
 
+# assets downloaded by default from each collection, when no selection is given (see select_assets).
+# The collections that are not here are downloaded with all their assets.
+default_assets = {
+    s2_collection: None,
+    'landsat-c2-l2': dict(exclude=['thumbnail', 'reduced_resolution_browse', 'tilejson', 'rendered_preview']),
+    'sentinel-1-rtc': dict(include=['vv', 'vh']),
+    'sentinel-1-grd': dict(include=['vv', 'vh']),
+    'cop-dem-glo-30': dict(include=['data']),
+    'cop-dem-glo-90': dict(include=['data']),
+}
+
+# columns of the records of the downloaded images (see download_item)
+results_columns = ['status', 'bytes', 'duration', 'retries', 'error', 'failed']
+
 
 class DownPlanet:
 
-    def __init__(self, catalog: str = catalog_url, logger_level=logging.INFO):
+    def __init__(self, catalog: str = catalog_url, logger_level=logging.INFO, session=None,
+                 pool_connections: int = 10, pool_maxsize: int = 32, cache: Union[str, Path, SearchCache] = None,
+                 properties: list = None, collections: Union[str, list] = s2_collection, assets: dict = None):
         """
-        Create a Sentinel 2 downloader for Microsoft Planetary Computer
-        :param catalog: STAC catalog to connect to. Defaults to "https://planetarycomputer.microsoft.com/api/stac/v1"
+        Create a downloader for Microsoft Planetary Computer. It searches Sentinel 2 by default.
+        :param catalog: STAC catalog to connect to. Defaults to "https://planetarycomputer.microsoft.com/api/stac/v1".
+        If None, no catalog is opened and the downloader can only download items (see download_item).
         :param logger_level: verbosity Level.
+        :param session: requests session used for all the downloads. If None, a session that retries broken
+        connections is created. The session is kept alive, so connections are reused across items and assets.
+        It is not used by the worker processes of download_all(executor='process'), which create their own
+        sessions with the same pool sizes.
+        :param pool_connections: number of hosts whose connections are kept in the pool (for a new session)
+        :param pool_maxsize: number of connections kept for each host (for a new session). It should not be
+        smaller than the number of simultaneous connections used by download_all.
+        :param cache: SearchCache (or path of its SQLite file) to keep the results of the searches on disk.
+        If None, the searches are not cached.
+        :param properties: properties of the items kept as columns of the search_df, e.g. ['datetime',
+        'eo:cloud_cover', 's2:mgrs_tile']. If None, all the properties are kept. See items_df.
+        :param collections: collection or list of collections searched by default, e.g. ['sentinel-2-l2a',
+        'landsat-c2-l2']
+        :param assets: default selection of assets per collection, e.g. {'landsat-c2-l2': dict(include=['red',
+        'nir08'])}, updating the module's default_assets. It is used when no include, exclude or resolutions
+        are given to the downloads.
         """
 
         # create a logger
@@ -34,16 +83,51 @@ class DownPlanet:
         for logger in loggers:
             logger.setLevel(logger_level)
 
+        self.catalog_url = catalog
+
         try:
-            self.catalog = Client.open(catalog)
+            # without a catalog, the downloader can only download items that are given to it
+            if catalog is not None:
+                self.catalog = Client.open(catalog)
 
         except Exception as e:
             self.logger.error(f"It was not possible to open catalog: '{catalog}'.")
             self.logger.error(f'Please pass a valid STAC catalog or use the default {catalog_url}')
 
+        # long-lived session, shared by all the downloads.
+        # Bad status codes are not retried by the session, they are handled per asset by _download_asset.
+        if session is None:
+            session = requests_retry_session(5, status_forcelist=(), pool_connections=pool_connections,
+                                             pool_maxsize=pool_maxsize)
+        self.session = session
+        self.pool_connections, self.pool_maxsize = pool_connections, pool_maxsize
+
+        # SAS tokens per storage container, shared by all the downloads
+        self.tokens = TokenCache(session=self.session)
+
+        # sizes, ETags and MD5s of the assets already probed {href: (size, etag, md5)}. Clear it to probe them again
+        self.size_cache = {}
+
+        # persistent cache of the searches
+        self.cache = SearchCache(cache) if isinstance(cache, (str, Path)) else cache
+
+        self.properties = properties
+
+        self.collections = [collections] if isinstance(collections, str) else list(collections)
+        self.default_assets = {**default_assets, **(assets or {})}
+
         self.search_df = None
+        self.results_df = None
 
-    def search(self, geometry: Union[list, tuple], start_date: str, end_date: str = None):
+        # index of the search_df, built when it is first used (see search_index)
+        self._search_index = None
+
+        # ids of the items that intersect each AOI of the last search_many {aoi: [ids]}
+        self.aoi_items = None
+
+    def search(self, geometry: Union[list, tuple], start_date: str, end_date: str = None, refresh: bool = False,
+               query: dict = None, filter: Union[dict, str] = None, fields: Union[list, dict] = None,
+               max_items: int = None, page_size: int = 100, collections: Union[str, list] = None):
         """
         Search for images.
         :param geometry: Polygon in the format [(long1, lat1), (long2, lat2), ...]
@@ -53,70 +137,623 @@ class DownPlanet:
         - ``2017`` expands to ``2017-01-01T00:00:00Z/2017-12-31T23:59:59Z``
         - ``2017-06`` expands to ``2017-06-01T00:00:00Z/2017-06-30T23:59:59Z``
         - ``2017-06-10`` expands to ``2017-06-10T00:00:00Z/2017-06-10T23:59:59Z``
+        :param refresh: if True, ignore the cached search (if there is a cache). See iter_search.
+        :param query: filters on the properties, applied by the server (STAC query extension),
+        e.g. {'eo:cloud_cover': {'lt': 20}, 's2:mgrs_tile': {'eq': '22KGA'}}
+        :param filter: CQL2 filter applied by the server, as a dict (cql2-json) or a string (cql2-text)
+        :param fields: properties returned by the server (fields extension), e.g. ['id', 'properties.datetime']
+        or {'include': [...], 'exclude': [...]}
+        :param max_items: maximum number of items returned
+        :param page_size: number of items requested per page (limit)
+        :param collections: collection or list of collections to search. If None, the downloader's collections.
+        Several collections are searched at the same time.
         :return: a list of images
         """
 
+        # join the pages of results in a single data frame
+        pages = list(self.iter_search(geometry, start_date, end_date=end_date, page_size=page_size, refresh=refresh,
+                                      query=query, filter=filter, fields=fields, max_items=max_items,
+                                      collections=collections))
+        self.search_df = self._concat_pages(pages)
+
+        self.logger.info(f'{len(self.search_df)} images found. Access .search_df for the list.')
+
+    def search_many(self, aois, start_date: str, end_date: str = None, max_size: float = 1., workers: int = 4,
+                    **kwargs):
+        """
+        Search for the images of many areas of interest (e.g. field polygons) at once.
+        Nearby AOIs are grouped in clusters and each cluster is searched by its bounding box, so there is one
+        API call per cluster instead of one per AOI. The clusters are searched at the same time and the items
+        shared by several AOIs are kept once in .search_df. The items of a cluster that do not intersect any of
+        its AOIs are dropped. The footprints of the items are tested if shapely is installed, otherwise their bboxes.
+        :param aois: list of geometries (as in search), dictionary {name: geometry} or GeoDataFrame (the index
+        names the AOIs). Objects with __geo_interface__ (e.g. shapely geometries) are accepted as geometries.
+        :param start_date: First date in the formats 'yyyy-mm-dd', 'yyyy-mm' or 'yyyy'
+        :param end_date: Last date. If end_date is None, the start_date will be expanded (see search)
+        :param max_size: maximum width and height (in degrees) of the bounding box of a cluster
+        :param workers: number of clusters searched at the same time
+        :param kwargs: other arguments passed to iter_search (query, filter, collections...)
+        :return: dictionary {aoi: list of ids of the items that intersect the aoi}. It is also stored in
+        .aoi_items
+        """
+
+        if hasattr(aois, 'geometry') and hasattr(aois, 'index'):
+            aois = dict(zip(aois.index, aois.geometry))
+        elif not isinstance(aois, dict):
+            aois = dict(enumerate(aois))
+
+        names = list(aois)
+        clusters = cluster_bounds([geometry_bounds(aois[name]) for name in names], max_size=max_size)
+        self.logger.info(f'{len(names)} AOIs grouped in {len(clusters)} searches')
+
+        def search_cluster(bounds):
+            # a small margin keeps the polygon valid when the cluster is a single point
+            x_min, y_min, x_max, y_max = bounds[0] - 1e-6, bounds[1] - 1e-6, bounds[2] + 1e-6, bounds[3] + 1e-6
+            polygon = [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max)]
+            return list(self.iter_search(polygon, start_date, end_date=end_date, **kwargs))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = [page for cluster_pages in executor.map(search_cluster, [bounds for bounds, _ in clusters])
+                     for page in cluster_pages]
+
+        df = self._concat_pages(pages)
+        self.search_df = df[~df.index.duplicated()]
+
+        # map each AOI to the items that intersect it and keep just these items
+        index = SearchIndex(self.search_df)
+        self.aoi_items = {name: list(index.covering(aois[name], exact=shapely is not None).index) for name in names}
+        mapped = {idx for ids in self.aoi_items.values() for idx in ids}
+        self.search_df = self.search_df[self.search_df.index.isin(mapped)]
+        self.logger.info(f'{len(self.search_df)} images found. Access .search_df for the list.')
+
+        return self.aoi_items
+
+    def iter_search(self, geometry: Union[list, tuple], start_date: str, end_date: str = None,
+                    page_size: int = 100, refresh: bool = False, query: dict = None,
+                    filter: Union[dict, str] = None, fields: Union[list, dict] = None, max_items: int = None,
+                    collections: Union[str, list] = None):
+        """
+        Search for images, yielding the results page by page, as they arrive. See search.
+        If the downloader has a cache, a fresh cached search is used without asking the API. An expired one is
+        refreshed by asking just for the items updated after the latest cached item.
+        :param geometry: Polygon in the format [(long1, lat1), (long2, lat2), ...] or Point (long, lat)
+        :param start_date: First date in the formats 'yyyy-mm-dd', 'yyyy-mm' or 'yyyy'
+        :param end_date: Last date. If end_date is None, the start_date will be expanded (see search)
+        :param page_size: number of items requested per page
+        :param refresh: if True, ignore the cached search and ask the API for all the items again
+        :param query: filters on the properties, applied by the server. See search.
+        :param filter: CQL2 filter applied by the server. See search.
+        :param fields: properties returned by the server. See search.
+        :param max_items: maximum number of items returned
+        :param collections: collection or list of collections to search. See search.
+        :return: generator of dataframes (see items_df), one per page
+        """
+
+        params = self._search_params(geometry, start_date, end_date=end_date, query=query, filter=filter,
+                                     fields=fields, max_items=max_items, collections=collections)
+
+        if self.cache is None:
+            for items in self._search_pages(params, page_size):
+                yield self.items_df(items, properties=self.properties)
+            return
+
+        key = self.cache.key(params)
+        cached = self.cache.get(key) if not refresh else None
+
+        if cached is not None and not cached['fresh'] and cached['last_updated'] is not None:
+            # ask just for the items updated after the last cached one, and merge them
+            query = {**params.get('query', {}), 'updated': {'gt': cached['last_updated']}}
+            new_items = [item for items in self._search_pages({**params, 'query': query}, page_size)
+                         for item in items]
+
+            self.logger.info(f'{len(new_items)} images updated since the cached search')
+            self.cache.put(key, params, new_items, replace=False)
+            cached = dict(self.cache.get(key), fresh=True)
+
+        if cached is not None and cached['fresh']:
+            self.logger.debug(f'Using cached search {key}')
+            for i in range(0, len(cached['items']), page_size):
+                yield self.items_df(cached['items'][i:i + page_size], properties=self.properties)
+            return
+
+        # the pages are yielded as they arrive and the whole search is cached at the end
+        all_items = []
+        for items in self._search_pages(params, page_size):
+            all_items.extend(items)
+            yield self.items_df(items, properties=self.properties)
+
+        self.cache.put(key, params, all_items)
+
+    def _search_params(self, geometry, start_date: str, end_date: str = None, query: dict = None,
+                       filter: Union[dict, str] = None, fields: Union[list, dict] = None, max_items: int = None,
+                       collections: Union[str, list] = None) -> dict:
+        """
+        Create the parameters of a search, that also key it in the cache. See iter_search.
+        :return: dictionary with the collections, datetime, intersects and the filters that are given
+        """
+
         # create the date range
         date_range = (start_date + '/' + end_date) if end_date is not None else start_date
 
         # check the geometry
         aoi = create_geometry(geometry, logger=self.logger)
 
-        search = self.catalog.search(collections=["sentinel-2-l2a"],
-                                     datetime=date_range,
-                                     intersects=aoi)
+        collections = self.collections if collections is None else \
+            [collections] if isinstance(collections, str) else list(collections)
 
-        # create a list with the items and save them in a data frame
-        items = list(search.get_items())
-        self.search_df = pd.DataFrame({item.id: item.properties for item in items}).T
-        self.search_df.index.name = 'id'
+        params = dict(collections=collections, datetime=date_range, intersects=dict(aoi))
 
-        # append the item objects to the dataframe
-        self.search_df['item'] = items
+        # the filters are applied by the server, so only the selected items (and fields) are transferred
+        extra = dict(query=query, filter=filter, fields=fields, max_items=max_items)
+        params.update({name: value for name, value in extra.items() if value is not None})
+        return params
 
-        self.logger.info(f'{len(self.search_df)} images found. Access .search_df for the list.')
+    def _search_pages(self, params: dict, page_size: int = 100):
+        """
+        Search the catalog and yield the list of items of each page.
+        With several collections, each collection is searched by its own thread and the pages are yielded as
+        they arrive, so the paging of one collection does not wait for the others.
+        :param params: arguments of the search (see pystac_client.Client.search)
+        :param page_size: number of items requested per page
+        """
+
+        collections = params.get('collections') or []
+        if len(collections) < 2:
+            yield from self._search_collection(params, page_size)
+            return
+
+        pages = queue.Queue()
+
+        def fetch(collection):
+            try:
+                for items in self._search_collection({**params, 'collections': [collection]}, page_size):
+                    pages.put(items)
+            except Exception as e:
+                pages.put(e)
+            finally:
+                pages.put(None)
+
+        max_items, count = params.get('max_items'), 0
+        with ThreadPoolExecutor(max_workers=len(collections)) as executor:
+            for collection in collections:
+                executor.submit(fetch, collection)
+
+            # each thread sends a sentinel (None) when its collection is over
+            for _ in collections:
+                for items in iter(pages.get, None):
+                    if isinstance(items, Exception):
+                        raise items
+
+                    if max_items is not None:
+                        items = items[:max(max_items - count, 0)]
+                    count += len(items)
+
+                    if items:
+                        yield items
+
+    def _search_collection(self, params: dict, page_size: int = 100):
+        """Search the catalog (one or more collections together) and yield the list of items of each page."""
+
+        search = self.catalog.search(**params, limit=page_size)
+
+        # older versions of pystac_client call the pages item collections
+        pages = search.pages() if hasattr(search, 'pages') else search.get_item_collections()
+
+        for page in pages:
+            self.logger.debug(f'Page with {len(page.items)} images received')
+            yield list(page.items)
+
+    @staticmethod
+    def items_df(items, properties: list = None):
+        """
+        Create a compact dataframe with the properties of the items, indexed by id.
+        The columns are typed (see common.compact_df) and the items are kept serialized as JSON in the
+        column 'item'. They are rehydrated on demand by get_item.
+        :param items: list of STAC items
+        :param properties: properties kept as columns. If None, all the properties are kept.
+        :return: dataframe with the properties and the serialized items in the column 'item'
+        """
+
+        # the properties of the dictionary include the datetime of the item
+        dicts = [item.to_dict(transform_hrefs=False) for item in items]
+        records = [d['properties'] if properties is None else
+                   {name: d['properties'].get(name) for name in properties} for d in dicts]
+
+        df = pd.DataFrame.from_records(records, index=pd.Index([item.id for item in items], name='id'),
+                                       columns=properties)
+        df = compact_df(df)
+
+        # append the collections and the serialized items to the dataframe
+        df['collection'] = pd.Categorical([d.get('collection') for d in dicts])
+        df['item'] = [json.dumps(d) for d in dicts]
+
+        return df
+
+    def _concat_pages(self, pages):
+        """Join the dataframes of the pages of results. The categories of each page are merged."""
+        if not pages:
+            return self.items_df([], properties=self.properties)
+
+        return compact_df(pd.concat(pages))
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """
+        Spatial and temporal index over the search_df, e.g. .search_index.best_per_tile(max_cloud=20).
+        It is built on first use and rebuilt when the search_df changes. See SearchIndex.
+        """
+
+        if self.search_df is None:
+            raise ValueError('No search dataframe (.search_df). Do a search first.')
+
+        if self._search_index is None or self._search_index.df is not self.search_df:
+            self._search_index = SearchIndex(self.search_df)
+
+        return self._search_index
+
+    def deduplicate(self, covered: bool = False):
+        """
+        Drop from the search_df the items that repeat the same acquisition (same tile and sensing datetime),
+        keeping the newest processing baseline, so the same pixels are not downloaded twice.
+        :param covered: if True, also drop the items whose footprint is fully covered by another item of the
+        same day. Requires shapely. See SearchIndex.deduplicate.
+        :return: the new search_df
+        """
+
+        df = self.search_index.deduplicate(covered=covered)
+        self.logger.info(f'{len(self.search_df) - len(df)} duplicated images dropped. {len(df)} images left.')
+
+        self.search_df = df
+        return self.search_df
+
+    def get_item(self, idx: str):
+        """
+        Get an item of the search_df as a STAC item.
+        :param idx: index (id) of the item
+        :return: pystac.Item
+        """
+
+        return _load_item(self.search_df.loc[idx, 'item'])
+
+    def download_all(self, out_dir: Union[Path, str], show_pbar=True, retries=3, max_workers: int = 4,
+                     workers: int = 1, max_connections: int = None, executor: str = 'thread', dry_run: bool = False,
+                     **kwargs):
+        """
+        Download all the images that are in the search_df to the out_dir.
+        The images are taken from a work queue by `workers` threads (or processes), so several images can be
+        downloaded at once. An existing out_dir is synced: the files that match the expected size, ETag and
+        checksum are skipped, and just the missing or changed assets are downloaded.
+        :param out_dir: output directory
+        :param show_pbar: if True, show a progress bar with the number of images downloaded
+        :param retries: number of retries for each asset
+        :param max_workers: number of assets of the same image downloaded in parallel
+        :param workers: number of images downloaded in parallel
+        :param max_connections: global limit of simultaneous connections (images x assets).
+        Defaults to workers * max_workers. Not applicable to the 'process' executor.
+        :param executor: 'thread' or 'process'. With 'process', each worker is a process with its own session
+        and token cache, which avoids the GIL limiting the throughput on multi-core hosts. The processes create
+        their sessions with the downloader's pool sizes; a custom session is not used.
+        :param dry_run: if True, nothing is downloaded. The delta between the out_dir and the search is returned
+        instead (see plan).
+        :param kwargs: other arguments passed to download_item
+        :return: dataframe with one record per image (status, bytes, duration, retries, error).
+        It is also stored in .results_df
+        """
+
+        if dry_run:
+            selection = {name: kwargs[name] for name in ('include', 'exclude', 'resolutions', 'probe', 'clip',
+                                                         'overview') if name in kwargs}
+            return self.plan(out_dir, max_workers=max_workers, workers=workers, **selection)
+
+        if executor == 'process':
+            records = self._download_processes(out_dir, show_pbar=show_pbar, workers=workers, retries=retries,
+                                               max_workers=max_workers, **kwargs)
+
+        elif executor == 'thread':
+            records = self._download_threads(out_dir, show_pbar=show_pbar, workers=workers,
+                                             max_connections=max_connections, retries=retries,
+                                             max_workers=max_workers, **kwargs)
+
+        else:
+            raise ValueError(f"executor must be 'thread' or 'process', not '{executor}'")
 
-    def download_all(self, out_dir: Union[Path, str], show_pbar=True, retries=3):
+        return self._set_results(records)
+
+    def plan(self, out_dir: Union[Path, str], include=None, exclude=None, resolutions=None, probe: bool = True,
+             clip=None, overview: Union[int, dict] = None, max_workers: int = 4, workers: int = 1) -> pd.DataFrame:
+        """
+        Compare the out_dir with the items in the search_df, without downloading anything (dry run).
+        Each selected asset is checked against its file, as download_all would do: size, ETag (probed with HEAD
+        requests) and checksum (file:checksum or MD5 informed by the server).
+        :param out_dir: output directory
+        :param include: patterns of the assets to keep. See download_item.
+        :param exclude: patterns of the assets to skip. See download_item.
+        :param resolutions: resolutions of the bands to keep. See download_item.
+        :param probe: if False, the sizes of the assets are not probed. See sign_item.
+        :param clip: area of interest of the COG assets. See download_item. The size of the clipped files is not
+        known in advance, so their bytes are NaN.
+        :param overview: overview level of the COG assets. See download_item.
+        :param max_workers: number of HEAD requests made in parallel for each image
+        :param workers: number of images checked in parallel
+        :return: dataframe indexed by the id of the images, with one row per asset: asset, file, status
+        ('current', 'partial', 'changed' or 'missing'), size and bytes to download (NaN if the size is unknown)
+        """
+
+        bounds = geometry_bounds(clip) if clip is not None else None
+
+        def plan_item(idx):
+            item = self.prepare_item(self.get_item(idx), include=include, exclude=exclude,
+                                     resolutions=resolutions, probe=probe, max_workers=max_workers)
+            folder = Path(out_dir)/(item.id + '.PC')
+            manifest = Manifest(folder)
+            levels = self._overview_levels(item, overview)
+            return [dict(id=idx, asset=name, **self._asset_delta(asset, folder, manifest, bounds=bounds,
+                                                                 overview=levels[name]))
+                    for name, asset in item.assets.items()]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = [row for rows in executor.map(plan_item, self.search_df.index) for row in rows]
+
+        plan_df = pd.DataFrame(rows, columns=['id', 'asset', 'file', 'status', 'size', 'bytes']).set_index('id')
+        plan_df['size'] = plan_df['size'].astype('float64')
+        plan_df['bytes'] = plan_df['bytes'].astype('float64')
+
+        pending = plan_df[plan_df['status'] != 'current']
+        self.logger.info(f'{len(pending)} of {len(plan_df)} asset(s) to download, '
+                         f'{pending["bytes"].sum():,.0f} bytes' +
+                         (f' ({pending["bytes"].isna().sum()} of unknown size)' if pending['bytes'].isna().any()
+                          else ''))
+
+        return plan_df
+
+    def _asset_delta(self, asset, out_dir, manifest, bounds=None, overview=None):
         """
-        Download all the images that are in the search_df to the out_dir
-        :param out_dir:
-        :param show_pbar:
-        :return:
+        Find what is missing of an asset in the out_dir of its image, without changing the files or the manifest.
+        :param bounds: bounds of the clip of the COG assets, if any
+        :param overview: overview level of the asset, if any
+        :return: dictionary with the file, status, size and bytes to download
         """
 
-        if show_pbar:
-            iterator = tqdm(self.search_df.index, desc='All images', unit=' img')
+        if (bounds is not None or overview is not None) and is_cog(asset):
+            # the size of a clipped file or overview is just known after reading it
+            file_name = Path(urlparse(asset.href).path).name
+            if self._cog_is_current(asset, out_dir, manifest, bounds=bounds, overview=overview):
+                return dict(file=file_name, status='current', size=getattr(asset, 'size', None), bytes=0)
+
+            status = 'changed' if (Path(out_dir)/file_name).exists() else 'missing'
+            return dict(file=file_name, status=status, size=getattr(asset, 'size', None), bytes=None)
+
+        state = self._asset_state(asset, out_dir, manifest, register=False)
+        size, entry = state['size'], manifest.get(state['file_name'])
+
+        if state['complete']:
+            status, missing = 'current', 0
+
+        elif state['offset'] or (entry.get('ranges') and state['part_path'].exists() and
+                                 state['etag'] in (None, entry.get('part_etag'))):
+            # a .part or the ranges of a .part (see _download_parts) that can be resumed
+            parts, done = entry.get('ranges'), entry.get('ranges_done') or []
+            if parts and size is not None:
+                done = sum(size * (i + 1) // parts - size * i // parts for i in done)
+            else:
+                done = state['offset']
+            status, missing = 'partial', size - done if size is not None else None
+
         else:
-            iterator = self.search_df.index
+            status, missing = 'changed' if state['file_path'].exists() else 'missing', size
+
+        return dict(file=state['file_name'], status=status, size=size, bytes=missing)
+
+    def _item_result(self, future, idx):
+        """Get the record of an image downloaded by a worker. An unexpected exception becomes a failed record."""
+        try:
+            return future.result()
+
+        except Exception as e:
+            self.logger.error(f'Problem downloading {idx}: {e}')
+            return dict(status='failed', bytes=0, duration=0., retries=0, error=str(e), failed={})
+
+    def _set_results(self, records):
+        """
+        Store the download records {id: record} in .results_df, in the same order as the search_df.
+        :return: the results_df
+        """
+
+        self.results_df = pd.DataFrame.from_dict(records, orient='index', columns=results_columns)
+        self.results_df = self.results_df.reindex(self.search_df.index)
+
+        failed = (self.results_df['status'] != 'done').sum()
+        if failed:
+            self.logger.warning(f'{failed} image(s) not downloaded. Check .results_df for details.')
+
+        return self.results_df
+
+    def _download_threads(self, out_dir, show_pbar=True, workers=1, max_connections=None, max_workers=4,
+                          **kwargs):
+        """Download the images of the search_df with a pool of threads. See download_all."""
+
+        # semaphore shared by all the downloads, to limit the total number of open connections
+        max_connections = max_connections if max_connections is not None else workers * max_workers
+        semaphore = threading.BoundedSemaphore(max_connections)
 
-        for idx in iterator:
-            # reset the retries count
-            counter = retries
+        # the items are loaded by the workers, so the whole catalog is not rebuilt before the first download
+        def download(idx):
+            return self.download_item(self.get_item(idx), out_dir, max_workers=max_workers, semaphore=semaphore,
+                                      **kwargs)
 
-            # will restart the download of the same image, if counter still 0
-            while counter > 0:
+        records = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(download, idx): idx for idx in self.search_df.index}
+
+            iterator = as_completed(futures)
+            if show_pbar:
+                iterator = tqdm(iterator, total=len(futures), desc='All images', unit=' img')
+
+            for future in iterator:
+                records[futures[future]] = self._item_result(future, futures[future])
+
+        return records
+
+    def _download_processes(self, out_dir, show_pbar=True, workers=1, **kwargs):
+        """
+        Download the images of the search_df with a pool of processes. See download_all.
+        Each process creates its own downloader (session and token cache), with the same default selection of
+        assets and pool sizes, and sends the bytes downloaded back through a queue, to update a single progress
+        bar. A custom session given to the downloader is not used by the processes.
+        """
+
+        records = {}
+        with multiprocessing.Manager() as manager:
+            progress = manager.Queue()
+
+            with tqdm(total=len(self.search_df), desc='All images', unit=' img', disable=not show_pbar) as images, \
+                    tqdm(unit_scale=True, unit='b', desc='Downloaded', smoothing=0, disable=not show_pbar) as pbar:
+
+                # update the bytes progress bar until the sentinel (None) arrives
+                def consume():
+                    for n in iter(progress.get, None):
+                        pbar.update(n)
+
+                consumer = threading.Thread(target=consume, daemon=True)
+                consumer.start()
+
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_process,
+                                         initargs=(self.logger.level, progress, self.default_assets,
+                                                   self.pool_connections, self.pool_maxsize)) as executor:
+                    # the items of a compact search_df are sent as their JSON strings, loaded by the processes
+                    futures = {executor.submit(_download_in_process, _item_json(self.search_df.loc[idx, 'item']),
+                                               out_dir, kwargs): idx
+                               for idx in self.search_df.index}
+
+                    for future in as_completed(futures):
+                        records[futures[future]] = self._item_result(future, futures[future])
+                        images.update(1)
+
+                progress.put(None)
+                consumer.join()
+
+        return records
+
+    def download_search(self, out_dir: Union[Path, str], geometry: Union[list, tuple], start_date: str,
+                        end_date: str = None, page_size: int = 100, show_pbar=True, max_workers: int = 4,
+                        workers: int = 1, max_connections: int = None, sign_workers: int = 2,
+                        queue_size: int = 16, include=None, exclude=None, resolutions=None, probe: bool = True,
+                        query: dict = None, filter: Union[dict, str] = None, max_items: int = None,
+                        collections: Union[str, list] = None, **kwargs):
+        """
+        Search for images and download them in a pipeline of three stages running at the same time:
+        fetching the pages of results, preparing the items (signing and probing sizes) and downloading them.
+        The stages are connected by bounded queues, so a slow stage holds back the previous ones.
+        At the end, the results are in .search_df and the records in .results_df
+        :param out_dir: output directory
+        :param geometry: Polygon in the format [(long1, lat1), (long2, lat2), ...] or Point (long, lat)
+        :param start_date: First date in the formats 'yyyy-mm-dd', 'yyyy-mm' or 'yyyy'
+        :param end_date: Last date. If end_date is None, the start_date will be expanded (see search)
+        :param page_size: number of items requested per page
+        :param show_pbar: if True, show a progress bar with the number of images downloaded
+        :param max_workers: number of assets of the same image downloaded (or probed) in parallel
+        :param workers: number of images downloaded in parallel
+        :param max_connections: global limit of simultaneous connections. Defaults to workers * max_workers.
+        :param sign_workers: number of images prepared in parallel
+        :param queue_size: maximum number of images waiting between two stages
+        :param include: patterns of the assets to download. See download_item.
+        :param exclude: patterns of the assets to skip. See download_item.
+        :param resolutions: resolutions of the bands to download. See download_item.
+        :param probe: if False, the sizes of the assets are not probed with HEAD requests. See sign_item.
+        :param query: filters on the properties, applied by the server. See search.
+        :param filter: CQL2 filter applied by the server. See search.
+        :param max_items: maximum number of items downloaded
+        :param collections: collection or list of collections to search. See search.
+        :param kwargs: other arguments passed to download_item
+        :return: dataframe with one record per image. See download_all.
+        """
+
+        max_connections = max_connections if max_connections is not None else workers * max_workers
+        semaphore = threading.BoundedSemaphore(max_connections)
+
+        to_sign, to_download = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+        pages, records, errors = [], {}, []
+
+        with tqdm(total=0, desc='All images', unit=' img', disable=not show_pbar) as images:
+
+            def fetch():
                 try:
-                    self.logger.debug(f'Downloading image {idx}')
-                    self.download(idx=idx, out_dir=out_dir)
-                    counter = 0
-                
+                    for page in self.iter_search(geometry, start_date, end_date=end_date, page_size=page_size,
+                                                 query=query, filter=filter, max_items=max_items,
+                                                 collections=collections):
+                        pages.append(page)
+                        images.total += len(page)
+                        images.refresh()
+
+                        for item in page['item']:
+                            to_sign.put(_load_item(item))
+
                 except Exception as e:
-                    self.logger.error(f'Problem downloading {idx}.')
-                    self.logger.error(e)
-                    counter -= 1
-                    if counter > 0:
-                        self.logger.error(f'Waiting 60 sec. {counter} Retries left')
-                        sleep(61)
-                    else:
-                        self.logger.error(f'Skipping image')
+                    errors.append(e)
+
+            def prepare():
+                for item in iter(to_sign.get, None):
+                    try:
+                        to_download.put(self.prepare_item(item, include=include, exclude=exclude,
+                                                          resolutions=resolutions, probe=probe,
+                                                          max_workers=max_workers))
+
+                    except Exception as e:
+                        self.logger.error(f'Problem signing {item.id}: {e}')
+                        records[item.id] = dict(status='failed', bytes=0, duration=0., retries=0, error=str(e),
+                                                failed={})
+                        images.update(1)
+
+            def download():
+                # a downloader must not stop on errors, otherwise the queues are not drained and prepare() blocks
+                for signed_item in iter(to_download.get, None):
+                    try:
+                        records[signed_item.id] = self.download_item(signed_item, out_dir, max_workers=max_workers,
+                                                                     semaphore=semaphore, sign=False, **kwargs)
+
+                    except Exception as e:
+                        self.logger.error(f'Problem downloading {signed_item.id}: {e}')
+                        records[signed_item.id] = dict(status='failed', bytes=0, duration=0., retries=0,
+                                                       error=str(e), failed={})
+                    images.update(1)
 
-    def download(self, idx: str, out_dir: Union[Path, str]):
+            fetcher = threading.Thread(target=fetch)
+            signers = [threading.Thread(target=prepare) for _ in range(sign_workers)]
+            downloaders = [threading.Thread(target=download) for _ in range(workers)]
+
+            for thread in [fetcher] + signers + downloaders:
+                thread.start()
+
+            # when a stage is over, send a sentinel (None) to each worker of the next stage
+            fetcher.join()
+            for _ in signers:
+                to_sign.put(None)
+
+            for thread in signers:
+                thread.join()
+            for _ in downloaders:
+                to_download.put(None)
+
+            for thread in downloaders:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        self.search_df = self._concat_pages(pages)
+        self.logger.info(f'{len(self.search_df)} images found. Access .search_df for the list.')
+
+        return self._set_results(records)
+
+    def download(self, idx: str, out_dir: Union[Path, str], **kwargs):
         """
         Download an item that is in the search_df. A directory for the specific item will be created in the
-        output directory
+        output directory. If any asset fails, a DownloadError is raised after the other assets are downloaded.
         :param idx: index of the item to download
         :param out_dir: output directory
-        :return: request response
+        :param kwargs: other arguments passed to download_item
+        :return: True if the item was downloaded (or was already complete). The bytes written are in the record
+        returned by download_item.
         """
 
         # check if there is a previous search
@@ -129,90 +766,829 @@ class DownPlanet:
             self.logger.warning(f'id not found in search dataframe (.search_df)')
             return
 
+        record = self.download_item(self.get_item(idx), out_dir, **kwargs)
+
+        if record['status'] == 'skipped':
+            return
+
+        if record['status'] == 'failed':
+            raise DownloadError(record['error'], failed=record['failed'])
+
+        return True
+
+    def download_item(self, item, out_dir: Union[Path, str], max_workers: int = 4, semaphore=None,
+                      retries: int = 3, backoff_factor: float = 1., overwrite: bool = False,
+                      chunk_size: int = CHUNK_SIZE, readinto: bool = False, fsync: bool = False,
+                      include=None, exclude=None, resolutions=None, probe: bool = True, pbar=None,
+                      sign: bool = True, clip=None, overview: Union[int, dict] = None, parts: int = 1,
+                      min_part_size: int = 16 * 2 ** 20, verify: bool = True):
+        """
+        Download a STAC item. A directory for the specific item will be created in the output directory.
+        The assets are downloaded in parallel by a pool of threads sharing the downloader's session.
+        Each asset is retried independently, so a failing asset does not restart the others.
+        If the directory already exists, complete assets are skipped and partial ones (.part) are resumed.
+        :param item: STAC item to download
+        :param out_dir: output directory
+        :param max_workers: number of assets downloaded in parallel. Use 1 for a sequential download.
+        :param semaphore: semaphore shared with other downloads to limit the number of simultaneous connections
+        :param retries: number of retries for each asset
+        :param backoff_factor: base delay (in seconds) of the exponential backoff between retries
+        :param overwrite: if True, remove the item's directory and download everything again
+        :param chunk_size: size (in bytes) of the chunks read from the connection. See download_asset.
+        :param readinto: if True, read the chunks into a preallocated buffer. See download_asset.
+        :param fsync: if True, flush each file to the disk when it is complete
+        :param include: pattern or list of patterns (glob) matching the key, media type or role of the assets
+        to download, e.g. ['B04', 'B08', 'SCL']. See common.select_assets
+        :param exclude: pattern or list of patterns of the assets to skip, e.g. ['preview', '*metadata*']
+        :param resolutions: resolution or list of resolutions (10, 20 or 60 m for Sentinel 2) of the bands
+        to download
+        :param probe: if False, the sizes of the assets are not probed with HEAD requests. See sign_item.
+        :param pbar: object with an update(n) method to report the bytes downloaded. If None, a progress bar
+        is created for the item.
+        :param sign: if False, the item is expected to be already prepared by prepare_item, and the arguments
+        include, exclude, resolutions and probe are ignored
+        :param clip: area of interest (geometry as in search). If given, just the part of the GeoTIFF (COG)
+        assets that covers it is read, with range requests, and written as a small GeoTIFF. The other assets are
+        downloaded entirely. Requires rasterio. See cog.read_window.
+        :param overview: overview level of the GeoTIFF (COG) assets to read instead of the full resolution
+        (0 is the first overview), e.g. for quick looks. A dictionary {pattern: level} selects the level per
+        asset, e.g. {'B0[2-4]': 2, 'SCL': 0}. The assets without level are downloaded at full resolution.
+        Can be combined with clip. Requires rasterio.
+        :param parts: maximum number of byte ranges of the same asset downloaded at the same time, to get more
+        throughput than a single connection. See _download_parts. The size of the assets must be known.
+        :param min_part_size: minimum size (in bytes) of each range. Smaller assets are downloaded in fewer parts.
+        :param verify: if True, check the checksum of the files (file:checksum of the asset or MD5 informed by the
+        server) and download them again if it does not match. The sizes are always checked.
+        :return: dictionary with status, bytes, duration, retries, error and failed assets {name: error}
+        """
+
+        record = dict(status='skipped', bytes=0, duration=0., retries=0, error=None, failed={})
+        start = perf_counter()
+
         # check if there the output directory exists
         out_dir = Path(out_dir)
         if not out_dir.exists():
             self.logger.warning(f'Output directory {str(out_dir)} does not exists. Create it first.')
-            return
-
-        # get the item to download
-        item = self.search_df.loc[idx, 'item']
+            return record
 
         # create the output folder for the image
         out_dir /= item.id + '.PC'
-        if out_dir.exists():
+        if out_dir.exists() and overwrite:
             rm_tree(out_dir)
         out_dir.mkdir(exist_ok=True)
 
-        # open a session that handles retries
-        session = requests_retry_session(5, status_forcelist=[500, 502, 503, 504])
+        # the manifest keeps the size and ETag of the files, to skip or resume them later
+        manifest = Manifest(out_dir)
 
-        # Sign the item. The hrefs of the assets are updated with a token
-        signed_item = self.sign_item(item, session=session)
+        try:
+            # Select the assets and sign them. The hrefs of the assets are updated with a token
+            signed_item = self.prepare_item(item, include=include, exclude=exclude, resolutions=resolutions,
+                                            probe=probe, max_workers=max_workers) if sign else item
 
-        # Download the assets
-        with tqdm(total=signed_item.size, unit_scale=True, unit='b', desc=signed_item.id, smoothing=0) as pbar:
-            for asset_name, asset in signed_item.assets.items():
-                self.logger.debug(f'Downloading asset {asset_name}')
-                self.download_asset(asset, out_dir, session=session, pbar=pbar)
+        except Exception as e:
+            self.logger.error(f'Problem signing {item.id}: {e}')
+            record.update(status='failed', error=str(e), duration=perf_counter() - start)
+            return record
 
-        return True
+        bounds = geometry_bounds(clip) if clip is not None else None
+
+        levels = self._overview_levels(signed_item, overview)
+
+        # Download the assets in parallel. All the workers update the same progress bar.
+        # The size of the clipped files and overviews is not known in advance.
+        partial = clip is not None or overview is not None
+        with tqdm(total=signed_item.size if not partial else None, unit_scale=True, unit='b',
+                  desc=signed_item.id, smoothing=0) if pbar is None else nullcontext(pbar) as pbar:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for name, asset in signed_item.assets.items():
+                    if (bounds is not None or levels[name] is not None) and is_cog(asset):
+                        future = executor.submit(self._read_cog_asset, asset, out_dir, bounds=bounds,
+                                                 overview=levels[name], manifest=manifest, pbar=pbar,
+                                                 semaphore=semaphore, retries=retries,
+                                                 backoff_factor=backoff_factor)
+                    elif parts > 1 and min(parts, (getattr(asset, 'size', None) or 0) // min_part_size) > 1:
+                        future = executor.submit(self._download_parts, asset, out_dir,
+                                                 parts=min(parts, asset.size // min_part_size), manifest=manifest,
+                                                 session=self.session, pbar=pbar, semaphore=semaphore,
+                                                 retries=retries, backoff_factor=backoff_factor,
+                                                 chunk_size=chunk_size, fsync=fsync, verify=verify)
+                    else:
+                        future = executor.submit(self._download_asset, asset, out_dir, session=self.session,
+                                                 pbar=pbar, semaphore=semaphore, retries=retries,
+                                                 backoff_factor=backoff_factor, manifest=manifest,
+                                                 chunk_size=chunk_size, readinto=readinto, fsync=fsync,
+                                                 verify=verify)
+                    futures[future] = name
+
+                for future in as_completed(futures):
+                    asset_name = futures[future]
+                    try:
+                        written, asset_retries = future.result()
+                        record['bytes'] += written
+                        record['retries'] += asset_retries
+                        self.logger.debug(f'Asset {asset_name} downloaded')
+
+                    except Exception as e:
+                        self.logger.error(f'Problem downloading asset {asset_name}: {e}')
+                        record['retries'] += getattr(e, 'retries', 0)
+                        record['failed'][asset_name] = str(e)
+
+        if record['failed']:
+            record.update(status='failed',
+                          error=f'{len(record["failed"])} asset(s) of {item.id} failed: {", ".join(record["failed"])}')
+        else:
+            record['status'] = 'done'
+
+        record['duration'] = perf_counter() - start
+        return record
 
-    def download_asset(self, asset, out_dir, session=None, pbar=None, sign=False):
+    @staticmethod
+    def _overview_levels(item, overview):
+        """Overview level of each asset of an item (None for the full resolution). See download_item."""
+        if not isinstance(overview, dict):
+            return {name: overview for name in item.assets}
+
+        return {name: next((level for pattern, level in overview.items() if match_asset(name, asset, [pattern])),
+                           None)
+                for name, asset in item.assets.items()}
+
+    def prepare_item(self, item, include=None, exclude=None, resolutions=None, probe: bool = True,
+                     max_workers: int = 4):
+        """
+        Select the assets of an item, sign them and probe their sizes, so the item is ready to be downloaded
+        with download_item(..., sign=False).
+        :param item: STAC item
+        :param include: patterns of the assets to keep. See download_item.
+        :param exclude: patterns of the assets to skip. See download_item.
+        :param resolutions: resolutions of the bands to keep. See download_item.
+        :param probe: if False, the sizes of the assets are not probed with HEAD requests. See sign_item.
+        :param max_workers: number of HEAD requests made in parallel
+        :return: signed item (see sign_item)
+        """
+
+        item = self.select_item_assets(item, include=include, exclude=exclude, resolutions=resolutions)
+
+        return self.sign_item(item, session=self.session, probe=probe, max_workers=max_workers,
+                              cache=self.size_cache, tokens=self.tokens)
+
+    def select_item_assets(self, item, include=None, exclude=None, resolutions=None):
+        """
+        Keep just the selected assets of an item. If no selection is given, the default selection of the item's
+        collection is used (see default_assets).
+        :param item: STAC item
+        :param include: patterns of the assets to keep. See download_item.
+        :param exclude: patterns of the assets to skip. See download_item.
+        :param resolutions: resolutions of the bands to keep. See download_item.
+        :return: a copy of the item with the selected assets, or the item itself if there is no selection
+        """
+
+        selection = dict(include=include, exclude=exclude, resolutions=resolutions)
+        if all(value is None for value in selection.values()):
+            selection = self.default_assets.get(item.collection_id) or {}
+
+        if not any(value is not None for value in selection.values()):
+            return item
+
+        item = item.clone()
+        item.assets = select_assets(item.assets, **selection)
+        self.logger.debug(f'{len(item.assets)} asset(s) selected for {item.id}')
+        return item
+
+    def download_asset(self, asset, out_dir, session=None, pbar=None, sign=False, semaphore=None,
+                       retries: int = 3, backoff_factor: float = 1., manifest=None,
+                       chunk_size: int = CHUNK_SIZE, readinto: bool = False, fsync: bool = False):
         """
         Download an asset to the out_dir.
+        The bytes are written to a .part file that is renamed when complete. If the asset has .size and .etag
+        members (see sign_item), complete files are skipped and a previous .part is resumed with a Range request.
+        Expired tokens (403) are renewed and retried immediately. Throttling (429), server errors (5xx) and
+        broken connections are retried with exponential backoff and jitter, honoring the Retry-After header.
         :param asset: Item's asset to download (must contain .href member)
         :param out_dir: output directory
-        :param session: Existing session. Otherwise, create it.
+        :param session: Existing session. Otherwise, use the downloader's session.
         :param pbar: if there is a progress bar, use it to update download
         :param sign: if True, sign the asset before starting the download
-        :return: request response
+        :param semaphore: if given, it is held while the connection is open
+        :param retries: number of retries before giving up
+        :param backoff_factor: base delay (in seconds) of the exponential backoff
+        :param manifest: Manifest of the out_dir. If None, it is opened.
+        :param chunk_size: size (in bytes) of the chunks read from the connection and written to disk.
+        The file is not flushed between chunks.
+        :param readinto: if True, read the chunks into a single preallocated buffer, instead of creating
+        a new bytes object for each chunk
+        :param fsync: if True, flush the file to the disk when it is complete
+        :return: number of bytes written
         """
 
-        # get the session
-        session = session if session is not None else requests
+        return self._download_asset(asset, out_dir, session=session, pbar=pbar, sign=sign, semaphore=semaphore,
+                                    retries=retries, backoff_factor=backoff_factor, manifest=manifest,
+                                    chunk_size=chunk_size, readinto=readinto, fsync=fsync)[0]
+
+    def _download_asset(self, asset, out_dir, sign=False, retries: int = 3, backoff_factor: float = 1.,
+                        manifest=None, pbar=None, **kwargs):
+        """
+        Download an asset retrying it according to the status of the failure. See download_asset.
+        :param kwargs: arguments passed to _get_asset
+        :return: tuple (number of bytes written, number of retries).
+        On failure, the exception raised receives a .retries member.
+        """
 
         # if asset not signed, sign the asset
-        href = pc.sign(asset.href) if sign else asset.href
+        href = self.tokens.sign(asset.href) if sign else asset.href
+
+        manifest = manifest if manifest is not None else Manifest(out_dir)
+
+        attempt = 0
+        while True:
+            # bytes of the failed attempt are discounted from the progress bar
+            progress = _Progress(pbar)
+
+            try:
+                return self._get_asset(asset, href, out_dir, pbar=progress, manifest=manifest, **kwargs), attempt
+
+            except (requests.HTTPError, requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, ChecksumError) as e:
+                progress.rollback()
 
-        # open the get request in background (stream=True)
-        r = session.get(href, stream=True)
+                # a file that does not match its checksum is downloaded again
+                status, headers = _failure(e)
+                delay = retry_delay(status, attempt, retries, backoff_factor=backoff_factor, headers=headers)
 
-        self.logger.debug(f'Downloading asset {asset.title}')
+                if delay is None:
+                    e.retries = attempt
+                    raise
+
+                attempt += 1
+
+                if status == 403:
+                    # the token has probably expired. Sign the original href again and retry immediately
+                    self.logger.warning(f'Access denied to {asset.title}. Renewing token ({attempt}/{retries})')
+                    href = self.tokens.sign(href, refresh=True)
+
+                else:
+                    self.logger.warning(f'Problem downloading {asset.title}: {e}. '
+                                        f'Retrying in {delay:.1f}s ({attempt}/{retries})')
+                    sleep(delay)
+
+    def _read_cog_asset(self, asset, out_dir, manifest, bounds=None, overview=None, pbar=None, semaphore=None,
+                        retries: int = 3, backoff_factor: float = 1.):
+        """
+        Write the part of a COG asset that covers the bounds and/or one of its overviews, retrying on failures.
+        See cog.read_window. The file is skipped if the manifest has it with the same bounds, overview and ETag.
+        When the server refuses the href (403, expired token), it is signed again before retrying.
+        :return: tuple (number of bytes written, number of retries)
+        """
+
+        file_name = Path(urlparse(asset.href).path).name
+        file_path = Path(out_dir)/file_name
+        etag = getattr(asset, 'etag', None)
+        clip = list(bounds) if bounds is not None else None
+
+        if self._cog_is_current(asset, out_dir, manifest, bounds=bounds, overview=overview):
+            self.logger.debug(f'Asset {asset.title} already read')
+            return 0, 0
+
+        href, attempt = asset.href, 0
+        while True:
+            try:
+                # GDAL opens its own connections, so the semaphore is held during the whole read
+                with semaphore if semaphore is not None else nullcontext():
+                    written = read_window(href, file_path, bounds=bounds, overview=overview)
+
+                manifest.update(file_name, size=written, etag=etag, clip=clip, overview=overview, part_etag=None)
+                if pbar is not None:
+                    pbar.update(written)
+                return written, attempt
+
+            except OSError as e:
+                # GDAL does not report the status of the failed requests
+                delay = retry_delay(None, attempt, retries, backoff_factor=backoff_factor)
+                if delay is None:
+                    e.retries = attempt
+                    raise
+
+                attempt += 1
+
+                # GDAL does not always report the status of the failed request (e.g. 'not recognized as being in
+                # a supported file format'), so the access is checked with a request for the first byte
+                if re.search(r'\b403\b', str(e)) or self._access_denied(href):
+                    self.logger.warning(f'Access denied to {asset.title}. Renewing token ({attempt}/{retries})')
+                    href = self.tokens.sign(href, refresh=True)
+                    continue
+
+                self.logger.warning(f'Problem reading {asset.title}: {e}. Retrying in {delay:.1f}s '
+                                    f'({attempt}/{retries})')
+                sleep(delay)
+
+    def _access_denied(self, href: str) -> bool:
+        """Check if the server refuses (403) an href, e.g. because its token has expired."""
+        try:
+            r = self.session.get(href, headers={'Range': 'bytes=0-0'})
+            r.close()
+            return r.status_code == 403
+
+        except requests.RequestException:
+            return False
+
+    @staticmethod
+    def _cog_is_current(asset, out_dir, manifest, bounds=None, overview=None):
+        """Check if the file of a COG asset was read (see _read_cog_asset) with the same bounds and overview."""
+        file_name = Path(urlparse(asset.href).path).name
+        file_path = Path(out_dir)/file_name
+        entry = manifest.get(file_name)
+
+        return file_path.exists() and entry.get('clip') == (list(bounds) if bounds is not None else None) and \
+            entry.get('overview') == overview and getattr(asset, 'etag', None) in (None, entry.get('etag')) and \
+            entry.get('size') == file_path.stat().st_size
+
+    def _get_asset(self, asset, href, out_dir, session=None, pbar=None, semaphore=None, manifest=None,
+                   chunk_size: int = CHUNK_SIZE, readinto: bool = False, fsync: bool = False, verify: bool = True):
+        """
+        Make one attempt to download an asset, resuming a previous .part file when possible.
+        The size of the file is checked against the Content-Length and, if verify is True, its checksum is
+        computed while the chunks are written and compared with the expected one (see common.expected_checksum).
+        A file that does not match is removed and a ChecksumError is raised.
+        :return: number of bytes written
+        """
+
+        # get the session
+        session = session if session is not None else self.session
+
+        state = self._asset_state(asset, out_dir, manifest)
+
+        # skip files that are already complete
+        if state['complete']:
+            self.logger.debug(f'Asset {asset.title} already downloaded')
+            if pbar is not None:
+                pbar.update(state['size'])
+            return 0
+
+        offset, etag, written, hasher = state['offset'], state['etag'], 0, None
+        expected = expected_checksum(asset) if verify else None
+
+        if offset and offset == state['size']:
+            etag, hasher = self._complete_part(state, etag, expected, pbar)
+
+        else:
+            # hold the semaphore (if any) while the connection is open
+            with semaphore if semaphore is not None else nullcontext():
+                # open the get request in background (stream=True)
+                r = session.get(href, stream=True, headers=state['headers'])
+
+                try:
+                    r.raise_for_status()
+
+                    offset, etag, expected, hasher = self._start_stream(asset, state, manifest, r.status_code,
+                                                                        r.headers, offset, etag, expected, verify,
+                                                                        pbar)
+
+                    with open(state['part_path'].as_posix(), 'ab' if offset else 'wb') as f:
+                        written = stream_to_file(r, f, chunk_size=chunk_size, readinto=readinto, pbar=pbar,
+                                                 hasher=hasher)
+
+                        if fsync:
+                            f.flush()
+                            os.fsync(f.fileno())
+
+                    self._check_length(asset, r.headers, written, requests.ConnectionError)
+
+                finally:
+                    r.close()
+
+        self._end_asset(asset, state, manifest, offset, written, etag, expected, hasher, requests.ConnectionError)
+        return written
+
+    # The steps below are shared by the download engines (see aioplanet.AsyncDownPlanet), that only differ in
+    # how the response is streamed to the .part file
+
+    def _complete_part(self, state, etag, expected, pbar=None):
+        """
+        Take over a .part file that is already complete: it was interrupted just before being renamed.
+        :return: tuple (etag, hasher updated with the whole .part or None)
+        """
+
+        etag = etag if etag is not None else state['part_etag']
+        if pbar is not None:
+            pbar.update(state['offset'])
+
+        hasher = hash_file(state['part_path'], hashlib.new(expected[0])) if expected is not None else None
+        return etag, hasher
+
+    def _start_stream(self, asset, state, manifest, status: int, headers, offset: int, etag, expected,
+                      verify: bool = True, pbar=None):
+        """
+        Prepare the .part file for the body of a response: decide whether it is resumed, pick the expected
+        checksum and hash the part already downloaded.
+        :param status: HTTP status of the response
+        :param headers: headers of the response
+        :return: tuple (offset, etag, expected, hasher). The body is appended at offset (0 to rewrite the file)
+        """
+
+        # if the server does not accept the range (or the file changed), it sends the whole file
+        if status != 206:
+            offset = 0
+
+        # the ETag may not have been probed
+        etag = etag if etag is not None else headers.get('ETag')
+
+        # the MD5 of the whole file may come with the response. The Content-MD5 of a range refers to
+        # the range, but x-ms-blob-content-md5 always refers to the whole blob
+        if verify and expected is None:
+            expected = expected_checksum(asset, headers=headers if status == 200 else
+                                         {'x-ms-blob-content-md5': headers.get('x-ms-blob-content-md5')})
+
+        # a resumed file is hashed from the start
+        hasher = None
+        if expected is not None:
+            hasher = hashlib.new(expected[0])
+            if offset:
+                hash_file(state['part_path'], hasher, limit=offset)
+
+        self.logger.debug(f'Downloading asset {asset.title}' + (f' from byte {offset}' if offset else ''))
+        manifest.update(state['file_name'], part_etag=etag)
+
+        if pbar is not None and offset:
+            pbar.update(offset)
+
+        return offset, etag, expected, hasher
+
+    @staticmethod
+    def _check_length(asset, headers, written: int, error=DownloadError):
+        """
+        Check the bytes written against the Content-Length. A truncated body is resumed by the next attempt.
+        :param error: exception raised, one that the engine retries
+        """
+
+        length = headers.get('Content-Length')
+        if length is not None and 'Content-Encoding' not in headers and written != int(length):
+            raise error(f'{asset.title} truncated: {written} of {length} bytes')
+
+    def _end_asset(self, asset, state, manifest, offset: int, written: int, etag, expected, hasher,
+                   error=DownloadError):
+        """
+        Check the size and the checksum of a .part file and rename it to its final name.
+        :param error: exception raised when the size does not match, one that the engine retries
+        """
+
+        if state['size'] is not None and offset + written != state['size']:
+            # a file longer than expected can not be resumed, it is downloaded again from the start
+            if offset + written > state['size']:
+                state['part_path'].unlink(missing_ok=True)
+                manifest.update(state['file_name'], part_etag=None)
+            raise error(f'{asset.title} has {offset + written} bytes, expected {state["size"]}')
+
+        checksum = self._check_checksum(asset, state, manifest, expected, hasher)
+
+        self._finish_asset(state, manifest, size=offset + written, etag=etag, checksum=checksum)
+
+    def _check_checksum(self, asset, state, manifest, expected, hasher):
+        """
+        Compare the checksum of a .part file with the expected one. If they do not match, the .part is removed.
+        :param expected: tuple (algorithm, hex digest) or None if there is nothing to check
+        :param hasher: hasher updated with the whole content of the .part
+        :return: checksum as 'algorithm:hex digest', or None if there was nothing to check
+        """
+
+        if expected is None or hasher is None:
+            return None
+
+        if hasher.hexdigest() != expected[1]:
+            state['part_path'].unlink()
+            manifest.update(state['file_name'], part_etag=None, ranges=None, ranges_done=None)
+            raise ChecksumError(f'{expected[0]} of {asset.title} does not match: {hasher.hexdigest()} '
+                                f'instead of {expected[1]}')
+
+        self.logger.debug(f'{expected[0]} of {asset.title} verified')
+        return f'{expected[0]}:{expected[1]}'
+
+    def _download_parts(self, asset, out_dir, parts: int, manifest, retries: int = 3, verify: bool = True,
+                        **kwargs):
+        """
+        Download an asset in several byte ranges at the same time. Each range is written at its offset of a
+        preallocated .part file, with its own file handle. The ranges are retried (and resumed) independently,
+        and the complete ones are kept in the manifest, so an interrupted download is resumed range by range.
+        If verify is True, the checksum of the assembled file is checked, and the whole asset is downloaded
+        again if it does not match. If the server does not accept ranges, the asset is downloaded in a single
+        stream (see _download_asset). The asset must have .size (see sign_item).
+        :param parts: number of ranges
+        :param kwargs: other arguments passed to _get_parts
+        :return: tuple (number of bytes written, number of retries).
+        On failure, the exception raised receives a .retries member.
+        """
+
+        attempt = 0
+        while True:
+            try:
+                written, range_retries = self._get_parts(asset, out_dir, parts, manifest, retries=retries,
+                                                         verify=verify, **kwargs)
+                return written, attempt + range_retries
+
+            except RangesNotSupported as e:
+                self.logger.info(f'{e}. Downloading it in a single stream')
+                state = self._asset_state(asset, out_dir, manifest)
+                state['part_path'].unlink(missing_ok=True)
+                manifest.update(state['file_name'], part_etag=None, ranges=None, ranges_done=None)
+
+                written, stream_retries = self._download_asset(asset, out_dir, manifest=manifest, retries=retries,
+                                                               verify=verify, **kwargs)
+                return written, attempt + stream_retries
+
+            except ChecksumError as e:
+                if attempt >= retries:
+                    e.retries = attempt
+                    raise
+
+                attempt += 1
+                self.logger.warning(f'{e}. Downloading it again ({attempt}/{retries})')
+
+    def _get_parts(self, asset, out_dir, parts: int, manifest, session=None, pbar=None, semaphore=None,
+                   retries: int = 3, backoff_factor: float = 1., chunk_size: int = CHUNK_SIZE, fsync: bool = False,
+                   verify: bool = True):
+        """
+        Make one attempt to download an asset in ranges. See _download_parts.
+        :return: tuple (number of bytes written, number of retries of the ranges)
+        """
+
+        session = session if session is not None else self.session
+        state = self._asset_state(asset, out_dir, manifest)
+
+        if state['complete']:
+            self.logger.debug(f'Asset {asset.title} already downloaded')
+            if pbar is not None:
+                pbar.update(state['size'])
+            return 0, 0
+
+        file_name, part_path, size, etag = state['file_name'], state['part_path'], state['size'], state['etag']
+        entry = manifest.get(file_name)
+
+        # byte ranges [start, end) of the parts
+        offsets = [size * i // parts for i in range(parts + 1)]
+        ranges = list(zip(offsets[:-1], offsets[1:]))
+
+        # the ranges already complete are kept if they belong to the same version (ETag) of the asset
+        done = set()
+        if entry.get('ranges') == parts and etag is not None and entry.get('part_etag') == etag and \
+                part_path.exists() and part_path.stat().st_size == size:
+            done = set(entry.get('ranges_done') or [])
+
+        else:
+            # preallocate the file, so each range can be written at its offset
+            with open(part_path.as_posix(), 'wb') as f:
+                f.truncate(size)
+
+        manifest.update(file_name, part_etag=etag, ranges=parts, ranges_done=sorted(done))
+        if pbar is not None:
+            pbar.update(sum(end - start for i, (start, end) in enumerate(ranges) if i in done))
+
+        lock = threading.Lock()
+
+        def get_range(i):
+            start, end = ranges[i]
+            href, offset, attempt = asset.href, start, 0
+
+            # If-Match makes the server refuse (412) the ranges of another version of the asset
+            headers = {'If-Match': etag} if etag is not None else {}
+
+            while True:
+                try:
+                    with semaphore if semaphore is not None else nullcontext():
+                        r = session.get(href, stream=True, headers={**headers, 'Range': f'bytes={offset}-{end - 1}'})
+
+                        try:
+                            r.raise_for_status()
+                            if r.status_code != 206:
+                                raise RangesNotSupported(f'The server does not accept ranges for {asset.title}')
+
+                            with open(part_path.as_posix(), 'r+b') as f:
+                                f.seek(offset)
+                                offset += stream_to_file(r, f, chunk_size=chunk_size, pbar=pbar)
+
+                        finally:
+                            r.close()
+
+                    # a connection closed before the end of the range is resumed from the last byte written
+                    if offset < end:
+                        raise requests.ConnectionError(f'Range {i} of {asset.title} interrupted at byte {offset}')
+
+                    with lock:
+                        done.add(i)
+                        manifest.update(file_name, ranges_done=sorted(done))
+
+                    return end - start, attempt
+
+                except (requests.HTTPError, requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError) as e:
+                    status, headers = _failure(e)
+                    delay = retry_delay(status, attempt, retries, backoff_factor=backoff_factor, headers=headers)
+
+                    if delay is None:
+                        e.retries = attempt
+                        raise
+
+                    attempt += 1
+
+                    if status == 403:
+                        href = self.tokens.sign(href, refresh=True)
+
+                    else:
+                        self.logger.warning(f'Problem downloading range {i} of {asset.title}: {e}. '
+                                            f'Retrying in {delay:.1f}s ({attempt}/{retries})')
+                        sleep(delay)
+
+        todo = [i for i in range(parts) if i not in done]
+        self.logger.debug(f'Downloading asset {asset.title} in {len(todo)} range(s)')
+
+        written, total_retries = 0, 0
+        with ThreadPoolExecutor(max_workers=max(len(todo), 1)) as executor:
+            for range_written, range_retries in executor.map(get_range, todo):
+                written += range_written
+                total_retries += range_retries
+
+        if fsync:
+            with open(part_path.as_posix(), 'r+b') as f:
+                os.fsync(f.fileno())
+
+        # the ranges arrive out of order, so the file is hashed once it is assembled
+        expected = expected_checksum(asset) if verify else None
+        hasher = hash_file(part_path, hashlib.new(expected[0])) if expected is not None else None
+        checksum = self._check_checksum(asset, state, manifest, expected, hasher)
+
+        self._finish_asset(state, manifest, size=size, etag=etag, checksum=checksum)
+        return written, total_retries
+
+    @staticmethod
+    def _asset_state(asset, out_dir, manifest, register: bool = True):
+        """
+        Compare an asset with the files in the out_dir, to know if it is complete or can be resumed.
+        A file that is not in the manifest (e.g. downloaded by an older version) is taken as complete if it has
+        the expected size and checksum (when known), and it is registered in the manifest.
+        :param register: if False, the manifest is not updated (dry run)
+        :return: dictionary with the file_name, file_path and part_path, the expected size and etag,
+        whether the file is complete, the offset to resume from, the part_etag and the headers for the request
+        """
 
         # create the output file name
         file_name = Path(urlparse(asset.href).path).name
         file_path = Path(out_dir)/file_name
+        part_path = file_path.with_name(file_name + '.part')
+
+        # expected size, ETag and checksum, as informed by the item and the HEAD request in sign_item
+        size, etag = getattr(asset, 'size', None), getattr(asset, 'etag', None)
+        expected = expected_checksum(asset)
+        entry = manifest.get(file_name)
+
+        if not entry and file_path.exists() and size is not None and file_path.stat().st_size == size:
+            checksum = None
+            if expected is not None:
+                checksum = f'{expected[0]}:{hash_file(file_path, hashlib.new(expected[0])).hexdigest()}'
+
+            if checksum in (None, ':'.join(expected or ())):
+                entry = dict(size=size, etag=etag, checksum=checksum)
+                if register:
+                    manifest.update(file_name, **entry)
 
-        with open(file_path.as_posix(), 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
-                    if pbar is not None:
-                        pbar.update(1024)
-            
+        # a checksum in the manifest must be the expected one, if it was computed with the same algorithm
+        checksum = entry.get('checksum')
+        same_checksum = expected is None or checksum is None or not checksum.startswith(expected[0] + ':') or \
+            checksum == ':'.join(expected)
+
+        # a file is complete if it matches the manifest. Size, ETag and checksum are checked when they are known.
+        # Clipped files and overviews (see _read_cog_asset) are not complete downloads
+        complete = file_path.exists() and entry.get('size') == file_path.stat().st_size and \
+            etag in (None, entry.get('etag')) and size in (None, entry.get('size')) and same_checksum and \
+            entry.get('clip') is None and entry.get('overview') is None
+
+        # a .part can only be resumed if it belongs to the same version (ETag) of the asset
+        # (the .part of a download in ranges is preallocated, it can only be resumed by _download_parts)
+        part_etag = entry.get('part_etag')
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if part_etag is None or etag not in (None, part_etag) or entry.get('ranges'):
+            offset = 0
+
+        # If-Range makes the server send the whole file if the .part is from another version
+        headers = {'Range': f'bytes={offset}-', 'If-Range': part_etag} if offset else {}
+
+        return dict(file_name=file_name, file_path=file_path, part_path=part_path, size=size, etag=etag,
+                    complete=complete, offset=offset, part_etag=part_etag, headers=headers)
+
+    @staticmethod
+    def _finish_asset(state, manifest, size, etag, checksum=None):
+        """Move the complete .part to its final name and register it in the manifest."""
+        os.replace(state['part_path'], state['file_path'])
+        manifest.update(state['file_name'], size=size, etag=etag, checksum=checksum, part_etag=None, ranges=None,
+                        ranges_done=None)
 
     @staticmethod
-    def sign_item(item, session=None):
+    def sign_item(item, session=None, probe: bool = True, max_workers: int = 8, cache: dict = None, tokens=None):
         """
         Sign all the assets in a specific item and calculate the total size.
+        The size of each asset is taken from its `file:size` field, if available. Otherwise, it is probed
+        with HEAD requests, made in parallel.
         :param item: stac_item
         :param session: Existing session. If None, create a simple session.
-        :return: item with assets' hrefs already signed and a member .size
+        :param probe: if False, no HEAD requests are made, and the sizes not in the metadata remain unknown
+        :param max_workers: number of HEAD requests made in parallel
+        :param cache: dictionary {href: (size, etag, md5)} with the results of previous probes. It is updated.
+        :param tokens: TokenCache used to sign the assets. If None, sign with planetary_computer.sign
+        :return: item with assets' hrefs already signed and a member .size (None if any size is unknown).
+        Each asset receives the members .size, .etag and .md5 (None if unknown)
         """
 
         # sign the whole item
-        signed_item = pc.sign(item)
+        signed_item = tokens.sign_item(item) if tokens is not None else pc.sign(item)
 
         session = session if session is not None else requests
+        cache = cache if cache is not None else {}
 
-        total_size = 0
+        def head(asset):
+            # the cache is keyed by the href without the token
+            href = asset.href.split('?')[0]
+            if href not in cache:
+                r = session.head(asset.href)
+                r.close()
+
+                # a failed probe is not cached, the size remains unknown and the download reports the error
+                if not r.ok:
+                    logging.getLogger('DownPlanet').warning(f'Could not probe {asset.title}: HTTP {r.status_code}')
+                    return
+
+                cache[href] = probe_result(r.headers)
+
+            asset.size, asset.etag, asset.md5 = cache[href]
+
+        to_probe = []
         for asset in signed_item.assets.values():
-            r = session.head(asset.href)
-            total_size += int(r.headers.get('content-length'))
-            r.close()
+            asset.size, asset.etag, asset.md5 = asset.extra_fields.get('file:size'), None, None
+            if asset.size is None and probe:
+                to_probe.append(asset)
+
+        # keep the size and ETag in the assets, to check for files already downloaded
+        if to_probe:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(head, to_probe))
+
+        sizes = [asset.size for asset in signed_item.assets.values()]
+        signed_item.size = sum(sizes) if None not in sizes else None
+
+        return signed_item
+
+
+# status and headers of the response of a failed request (None for broken connections and checksum errors)
+def _failure(e):
+    response = getattr(e, 'response', None)
+    return (response.status_code, response.headers) if response is not None else (None, None)
+
+
+# rehydrate an item of the search_df (serialized as JSON by items_df)
+def _load_item(value):
+    return value if isinstance(value, pystac.Item) else pystac.Item.from_dict(json.loads(value))
+
+
+# an item of the search_df as a JSON string, to be sent to another process
+def _item_json(value):
+    return value if isinstance(value, str) else json.dumps(value.to_dict())
+
+
+class _Progress:
+    """Wrap a progress bar to be able to undo the updates of a failed attempt."""
+
+    def __init__(self, pbar=None):
+        self.pbar = pbar
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+        if self.pbar is not None:
+            self.pbar.update(n)
+
+    def rollback(self):
+        if self.pbar is not None and self.n:
+            self.pbar.update(-self.n)
+        self.n = 0
+
+
+class _QueueProgress:
+    """Progress bar that sends its updates through a queue, to be shown by another process."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def update(self, n):
+        self.queue.put(n)
+
+
+# downloader and progress queue of each worker process of download_all(executor='process')
+_process_downloader, _process_queue = None, None
+
+
+def _init_process(logger_level, queue, assets, pool_connections, pool_maxsize):
+    global _process_downloader, _process_queue
+    _process_downloader = DownPlanet(catalog=None, logger_level=logger_level, assets=assets,
+                                     pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    _process_queue = queue
 
-        signed_item.size = total_size
 
-        return signed_item
\ No newline at end of file
+def _download_in_process(item_json, out_dir, kwargs):
+    item = _load_item(item_json)
+    return _process_downloader.download_item(item, out_dir, pbar=_QueueProgress(_process_queue), **kwargs)
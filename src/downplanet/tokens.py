@@ -0,0 +1,120 @@
+import logging
+import threading
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from planetary_computer.sas import SASToken, BLOB_STORAGE_DOMAIN, parse_blob_url
+from planetary_computer.settings import Settings
+
+from .common import retry_delay
+
+# status codes of the token endpoint that are worth retrying
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+class TokenCache:
+    """
+    Cache of SAS tokens per storage account/container.
+    A token is valid for the whole container for a long period, so it is requested once and reused by all the
+    items and assets in that container. Tokens are renewed before they expire, and the cache can be shared by
+    several download threads.
+    """
+
+    def __init__(self, session=None, margin: float = 600., retries: int = 5, backoff_factor: float = 1.):
+        """
+        :param session: session used to request the tokens. If None, use a simple session.
+        :param margin: renew the tokens that expire in less than `margin` seconds
+        :param retries: number of retries of a token request that fails with a broken connection, throttling
+        (429) or a server error (5xx)
+        :param backoff_factor: base delay (in seconds) of the exponential backoff between retries
+        """
+
+        self.session = session if session is not None else requests
+        self.margin = margin
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def get(self, account: str, container: str, stale: str = None) -> SASToken:
+        """
+        Get a valid token for a container.
+        :param account: storage account name
+        :param container: container name
+        :param stale: token that was rejected by the server. If it is the cached one, a new token is requested
+        even if it has not expired. If another thread has already renewed it, the new token is returned.
+        :return: SASToken with .token and .expiry
+        """
+
+        # the lock avoids several threads requesting the same token at once
+        with self.lock:
+            token = self.tokens.get((account, container))
+
+            if token is None or token.ttl() < self.margin or token.token == stale:
+                token = SASToken(**self._request(account, container))
+                self.tokens[(account, container)] = token
+
+            return token
+
+    def _request(self, account: str, container: str) -> dict:
+        """Request a new token, retrying the transient failures with exponential backoff."""
+
+        settings = Settings.get()
+        headers = {'Ocp-Apim-Subscription-Key': settings.subscription_key} if settings.subscription_key else None
+
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(f'{settings.sas_url}/{account}/{container}', headers=headers)
+                r.raise_for_status()
+                return r.json()
+
+            except (requests.HTTPError, requests.ConnectionError, requests.Timeout) as e:
+                response = getattr(e, 'response', None)
+                delay = retry_delay(response.status_code if response is not None else None, attempt, self.retries,
+                                    backoff_factor=self.backoff_factor,
+                                    headers=response.headers if response is not None else None,
+                                    statuses=retry_statuses)
+                if delay is None:
+                    raise
+
+                attempt += 1
+
+                logging.getLogger('DownPlanet').warning(f'Problem requesting a token for {account}/{container}: '
+                                                        f'{e}. Retrying in {delay:.1f}s ({attempt}/{self.retries})')
+                sleep(delay)
+
+    def sign(self, href: str, refresh: bool = False) -> str:
+        """
+        Sign an href with the token of its container. Hrefs outside the blob storage are returned unmodified.
+        :param href: href of the asset. If it is already signed, it is kept, unless refresh is True.
+        :param refresh: if True, renew the token of the href (e.g., after a 403) and sign it again
+        :return: signed href
+        """
+
+        # the public assets account (thumbnails) does not need tokens
+        parsed = urlparse(href)
+        if not parsed.netloc.endswith(BLOB_STORAGE_DOMAIN) or parsed.netloc.startswith('ai4edatasetspublicassets.'):
+            return href
+
+        # looks like it is already signed
+        if set(parse_qs(parsed.query)) & {'st', 'se', 'sp'} and not refresh:
+            return href
+
+        account, container = parse_blob_url(parsed)
+        token = self.get(account, container, stale=parsed.query if refresh else None)
+        return parsed._replace(query=token.token).geturl()
+
+    def sign_item(self, item):
+        """
+        Sign all the assets of a STAC item.
+        :param item: STAC item
+        :return: a copy of the item with the hrefs of the assets signed
+        """
+
+        signed_item = item.clone()
+        for asset in signed_item.assets.values():
+            asset.href = self.sign(asset.href)
+
+        return signed_item
@@ -0,0 +1,171 @@
+import base64
+import hashlib
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pystac
+import pytest
+
+from downplanet import DownPlanet
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Serve the files in server.files.
+    server.failures maps a path to a list of status codes to be returned by the first GET requests.
+    If server.ignore_ranges is True, the Range requests are answered with the whole file.
+    """
+
+    # keep the connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _get_file(self):
+        path = self.path.split('?')[0]
+        self.server.requests.append((self.command, path, self.headers.get('Range')))
+        self.server.clients.add(self.client_address)
+
+        failures = self.server.failures.get(path) if self.command == 'GET' else None
+        if failures:
+            self.send_response(failures.pop(0))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        if path not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        return self.server.files[path]
+
+    @staticmethod
+    def etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def do_HEAD(self):
+        data = self._get_file()
+        if data is not None:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', self.etag(data))
+            self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.bodies.append(body)
+
+        # the searches of a single collection may have their own results (see serve_stac_api)
+        collections = body.get('collections') or []
+        if len(collections) == 1 and f'{self.path}/{collections[0]}' in self.server.files:
+            self.path = f'{self.path}/{collections[0]}'
+
+        self.do_GET()
+
+    def do_GET(self):
+        data = self._get_file()
+        if data is None:
+            return
+
+        # If-Match must match the current ETag
+        if self.headers.get('If-Match', self.etag(data)) != self.etag(data):
+            self.send_response(412)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # answer Range requests only if the If-Range matches the current ETag
+        ranges = self.headers.get('Range') if not self.server.ignore_ranges else None
+        if ranges and self.headers.get('If-Range', self.etag(data)) == self.etag(data):
+            start, end = ranges.replace('bytes=', '').split('-')
+            end = int(end) if end else len(data) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            data = data[int(start):end + 1]
+        else:
+            self.send_response(200)
+            self.send_header('Content-MD5', base64.b64encode(hashlib.md5(data).digest()).decode())
+
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', self.etag(self.server.files[self.path.split('?')[0]]))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    httpd.files = {}
+    httpd.failures = {}
+    httpd.ignore_ranges = False
+    httpd.requests = []
+    httpd.clients = set()
+    httpd.bodies = []
+    httpd.url = f'http://127.0.0.1:{httpd.server_port}'
+
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_item(item_id, server, assets, properties=None):
+    """Create a STAC item whose assets {name: bytes} are served by the local server."""
+    item = pystac.Item(id=item_id, geometry=None, bbox=None, datetime=datetime(2021, 1, 1),
+                       properties=properties or {})
+
+    for name, data in assets.items():
+        path = f'/{item_id}/{name}.tif'
+        server.files[path] = data
+        item.add_asset(name, pystac.Asset(href=server.url + path, title=name))
+
+    return item
+
+
+@pytest.fixture
+def downloader():
+    # a downloader without a catalog, with a search_df filled manually
+    dp = DownPlanet(catalog=None)
+    dp.search_df = pd.DataFrame(columns=['item'])
+    dp.search_df.index.name = 'id'
+    return dp
+
+
+def add_items(downloader, items):
+    downloader.search_df = pd.DataFrame({'item': items}, index=[item.id for item in items])
+    downloader.search_df.index.name = 'id'
+
+
+def serve_stac_api(server, items, page_size, collection=None):
+    """
+    Serve a minimal STAC API whose searches return the items, page_size items per page.
+    If a collection is given, the items are returned just by the searches of that collection.
+    """
+    server.files['/'] = json.dumps({
+        'type': 'Catalog', 'id': 'test', 'description': 'test', 'stac_version': '1.0.0',
+        'conformsTo': ['https://api.stacspec.org/v1.0.0/core', 'https://api.stacspec.org/v1.0.0/item-search',
+                       'https://api.stacspec.org/v1.0.0/item-search#query',
+                       'https://api.stacspec.org/v1.0.0/item-search#fields',
+                       'https://api.stacspec.org/v1.0.0-rc.2/item-search#filter',
+                       'http://www.opengis.net/spec/cql2/1.0/conf/cql2-json',
+                       'http://www.opengis.net/spec/cql2/1.0/conf/basic-cql2'],
+        'links': [{'rel': 'self', 'href': server.url + '/'},
+                  {'rel': 'search', 'href': server.url + '/search', 'type': 'application/geo+json',
+                   'method': 'POST'}]
+    }).encode()
+
+    prefix = '/search' if collection is None else f'/search/{collection}'
+    pages = [items[i:i + page_size] for i in range(0, len(items), page_size)] or [[]]
+    for i, page in enumerate(pages):
+        links = [{'rel': 'next', 'href': f'{server.url}{prefix}/{i + 1}', 'method': 'GET'}] \
+            if i < len(pages) - 1 else []
+        path = prefix if i == 0 else f'{prefix}/{i}'
+        server.files[path] = json.dumps({'type': 'FeatureCollection', 'features': [item.to_dict() for item in page],
+                                         'links': links}).encode()
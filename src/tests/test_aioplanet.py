@@ -0,0 +1,80 @@
+import hashlib
+import json
+
+from downplanet import AsyncDownPlanet
+from downplanet.common import Manifest
+from tests.conftest import make_item, add_items
+
+
+def test_async_search_follows_pages(server):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'}, properties={'eo:cloud_cover': i}) for i in range(3)]
+    features = [item.to_dict() for item in items]
+
+    next_link = {'rel': 'next', 'href': server.url + '/search/2', 'method': 'GET'}
+    server.files['/search'] = json.dumps({'features': features[:2], 'links': [next_link]}).encode()
+    server.files['/search/2'] = json.dumps({'features': features[2:], 'links': []}).encode()
+
+    downloader = AsyncDownPlanet(catalog=None)
+    downloader.catalog_url = server.url
+    downloader.search((-48.4, -23.2), '2021')
+
+    assert list(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2']
+    assert downloader.get_item('S2A_2').id == 'S2A_2'
+
+    # the filters are sent to the server and the pages stop at max_items
+    downloader.search((-48.4, -23.2), '2021', query={'eo:cloud_cover': {'lt': 20}}, fields=['id', '-assets'],
+                      max_items=1)
+    assert server.bodies[-1]['query'] == {'eo:cloud_cover': {'lt': 20}} and server.bodies[-1]['limit'] == 1
+    assert server.bodies[-1]['fields'] == {'include': ['id'], 'exclude': ['assets']}
+    assert list(downloader.search_df.index) == ['S2A_0']
+
+
+def test_async_download_all(server, tmp_path):
+    downloader = AsyncDownPlanet(catalog=None)
+    items = [make_item(f'S2A_{i}', server, {'B01': b'x' * 1000 * i, 'B02': b'y' * 10}) for i in range(1, 5)]
+    add_items(downloader, items)
+    server.failures['/S2A_2/B01.tif'] = [503]
+    server.failures['/S2A_3/B02.tif'] = [404]
+
+    results = downloader.download_all(tmp_path, show_pbar=False, backoff_factor=0.01)
+
+    assert list(results['status']) == ['done', 'done', 'failed', 'done']
+    assert results.loc['S2A_2', 'retries'] == 1
+    assert (tmp_path/'S2A_4.PC'/'B01.tif').read_bytes() == b'x' * 4000
+
+    # a second run downloads just the failed asset
+    server.requests.clear()
+    results = downloader.download_all(tmp_path, show_pbar=False)
+    assert results['bytes'].sum() == 10
+    assert [path for method, path, _ in server.requests if method == 'GET'] == ['/S2A_3/B02.tif']
+
+
+def test_async_download_verifies_checksums(server, tmp_path):
+    downloader = AsyncDownPlanet(catalog=None)
+    item = make_item('S2A_SUM', server, {'B01': b'1' * 1000, 'B02': b'2' * 100})
+    item.assets['B01'].extra_fields['file:checksum'] = 'd50110' + hashlib.md5(b'1' * 1000).hexdigest()
+    item.assets['B02'].extra_fields['file:checksum'] = 'd50110' + hashlib.md5(b'other').hexdigest()
+    add_items(downloader, [item])
+
+    # the corrupted asset is downloaded again until the retries are exhausted
+    results = downloader.download_all(tmp_path, show_pbar=False, retries=2, backoff_factor=0.01)
+    assert results.loc['S2A_SUM', 'status'] == 'failed' and results.loc['S2A_SUM', 'retries'] == 2
+    assert [path for method, path, _ in server.requests if method == 'GET'].count('/S2A_SUM/B02.tif') == 3
+    assert Manifest(tmp_path/'S2A_SUM.PC').get('B01.tif')['checksum'] == \
+           'md5:' + hashlib.md5(b'1' * 1000).hexdigest()
+    assert not (tmp_path/'S2A_SUM.PC'/'B02.tif').exists()
+
+
+def test_async_search_uses_cache(server, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'}) for i in range(3)]
+    server.files['/search'] = json.dumps({'features': [item.to_dict() for item in items], 'links': []}).encode()
+
+    downloader = AsyncDownPlanet(catalog=None, cache=tmp_path/'cache.db')
+    downloader.catalog_url = server.url
+    downloader.search((-48.4, -23.2), '2021')
+    downloader.search((-48.4, -23.2), '2021')
+
+    assert len(server.bodies) == 1 and list(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2']
+
+    downloader.search((-48.4, -23.2), '2021', refresh=True)
+    assert len(server.bodies) == 2
@@ -0,0 +1,33 @@
+from downplanet import DownPlanet, SearchCache
+from tests.conftest import make_item, serve_stac_api
+
+
+def test_search_cache(server, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'}, properties={'updated': f'2021-01-0{i + 1}T00:00:00Z'})
+             for i in range(3)]
+    serve_stac_api(server, items, page_size=2)
+
+    cache = SearchCache(tmp_path/'cache.sqlite')
+    downloader = DownPlanet(catalog=server.url, cache=cache)
+    downloader.search((-48.4, -23.2), '2021')
+    assert len(server.bodies) == 1
+
+    # the same search (with an equivalent geometry) comes from the cache, even in a new downloader
+    downloader = DownPlanet(catalog=server.url, cache=tmp_path/'cache.sqlite')
+    downloader.search((-48.40000000001, -23.2), '2021')
+    assert len(server.bodies) == 1
+    assert list(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2']
+    assert downloader.get_item('S2A_1').id == 'S2A_1'
+
+    # a different search goes to the API
+    downloader.search((-48.4, -23.2), '2020')
+    assert len(server.bodies) == 2
+
+    # an expired search asks just for the items updated after the last cached one
+    new_item = make_item('S2A_3', server, {'B01': b'1'}, properties={'updated': '2021-02-01T00:00:00Z'})
+    serve_stac_api(server, [new_item], page_size=2)
+    downloader.cache.ttl = 0
+    downloader.search((-48.4, -23.2), '2021')
+
+    assert server.bodies[-1]['query'] == {'updated': {'gt': '2021-01-03T00:00:00Z'}}
+    assert list(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2', 'S2A_3']
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from tests.conftest import make_item, add_items
+
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_bounds  # noqa: E402
+
+
+def make_cog(path, size=1024):
+    """Write a tiled GeoTIFF of size x size pixels covering lon 0-1, lat 0-1."""
+    data = (np.arange(size * size) % 251).astype('uint8').reshape(1, size, size)
+    profile = dict(driver='GTiff', width=size, height=size, count=1, dtype='uint8', crs='EPSG:4326',
+                   transform=from_bounds(0, 0, 1, 1, size, size), tiled=True, blockxsize=256, blockysize=256)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data)
+
+    return path.read_bytes(), data
+
+
+def test_download_clip(server, downloader, tmp_path):
+    cog, data = make_cog(tmp_path/'cog.tif')
+    item = make_item('S2A_CLIP', server, {'B04': cog, 'meta': b'<xml/>'})
+    item.assets['meta'].media_type = 'application/xml'
+    add_items(downloader, [item])
+
+    out_dir = tmp_path/'out'
+    out_dir.mkdir()
+    aoi = [(0.1, 0.6), (0.2, 0.6), (0.2, 0.7), (0.1, 0.7)]
+    written = downloader.download_item(item, out_dir, clip=aoi)['bytes']
+
+    with rasterio.open(out_dir/'S2A_CLIP.PC'/'B04.tif') as src:
+        assert src.crs.to_epsg() == 4326
+        assert abs(src.bounds.left - 0.1) < 1e-2 and abs(src.bounds.top - 0.7) < 1e-2
+        row, col = src.index(0.15, 0.65)
+        full_row, full_col = round((1 - 0.65) * 1024 - 0.5), round(0.15 * 1024 - 0.5)
+        assert src.read(1)[row, col] == data[0, full_row, full_col]
+
+    # the metadata is downloaded entirely and much less than the whole COG is transferred
+    assert (out_dir/'S2A_CLIP.PC'/'meta.tif').read_bytes() == b'<xml/>'
+    assert written < len(cog)
+    assert all(r[2] is not None for r in server.requests if r[0] == 'GET' and r[1].endswith('B04.tif'))
+
+    # a second download skips the clipped file
+    server.requests.clear()
+    assert downloader.download('S2A_CLIP', out_dir, clip=aoi) is True
+    assert not [r for r in server.requests if r[0] == 'GET' and r[1].endswith('B04.tif')]
+
+    # a dry run with the same clip finds nothing to download, another clip needs the COG again
+    plan = downloader.download_all(out_dir, dry_run=True, clip=aoi)
+    assert (plan['status'] == 'current').all() and plan['bytes'].sum() == 0
+    plan = downloader.plan(out_dir, clip=(0.3, 0.3)).set_index('asset')
+    assert plan.loc['B04', 'status'] == 'changed' and plan.loc['meta', 'status'] == 'current'
+
+
+def test_download_overview(server, downloader, tmp_path):
+    path = tmp_path/'cog.tif'
+    make_cog(path)
+    with rasterio.open(path, 'r+') as dst:
+        dst.build_overviews([2, 4, 8])
+    cog = path.read_bytes()
+
+    item = make_item('S2A_OVR', server, {'B04': cog, 'B08': cog, 'SCL': cog})
+    add_items(downloader, [item])
+
+    out_dir = tmp_path/'out'
+    out_dir.mkdir()
+    downloader.download('S2A_OVR', out_dir, overview={'B0*': 1, 'SCL': 10})
+
+    shapes = {}
+    for name in ['B04', 'B08', 'SCL']:
+        with rasterio.open(out_dir/'S2A_OVR.PC'/f'{name}.tif') as src:
+            shapes[name] = src.shape
+            assert src.bounds == rasterio.coords.BoundingBox(0, 0, 1, 1)
+
+    # the level is limited to the coarsest overview
+    assert shapes == {'B04': (256, 256), 'B08': (256, 256), 'SCL': (128, 128)}
+
+    # the full resolution download replaces the overview
+    downloader.download('S2A_OVR', out_dir, include='B04')
+    assert (out_dir/'S2A_OVR.PC'/'B04.tif').read_bytes() == cog
+
+
+def test_clip_renews_expired_token(server, downloader, tmp_path):
+    cog, _ = make_cog(tmp_path/'cog.tif')
+    item = make_item('S2A_CLIP', server, {'B04': cog})
+    # GDAL tries to open the file twice, then the access is checked
+    server.failures['/S2A_CLIP/B04.tif'] = [403] * 3
+
+    # the new token makes a different href, so GDAL does not reuse the failure
+    renewed = []
+    original = downloader.tokens.sign
+
+    def sign(href, refresh=False):
+        if refresh:
+            renewed.append(href)
+            return href.split('?')[0] + '?token=2'
+        return original(href, refresh)
+
+    downloader.tokens.sign = sign
+
+    out_dir = tmp_path/'out'
+    out_dir.mkdir()
+    record = downloader.download_item(item, out_dir, clip=[(0.1, 0.6), (0.2, 0.6), (0.2, 0.7)], backoff_factor=0.01)
+
+    assert record['status'] == 'done' and record['retries'] == 1 and len(renewed) == 1
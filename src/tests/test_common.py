@@ -0,0 +1,57 @@
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pystac
+
+from downplanet.common import backoff_delay, parse_retry_after, select_assets, expected_checksum, compact_df
+
+
+def test_backoff_delay():
+    for attempt in range(1, 6):
+        assert 0 <= backoff_delay(attempt, backoff_factor=1.) <= 2 ** (attempt - 1)
+
+    assert backoff_delay(10, backoff_factor=1., max_delay=5.) <= 5.
+    assert backoff_delay(1, backoff_factor=1., retry_after=30) == 30
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('120') == 120.
+    assert parse_retry_after('not a date') is None
+
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 50 < parse_retry_after(date) <= 60
+
+
+def test_select_assets():
+    assets = {
+        'B02': pystac.Asset('B02.tif', media_type='image/tiff', roles=['data'], extra_fields={'gsd': 10.0}),
+        'B05': pystac.Asset('B05.tif', media_type='image/tiff', roles=['data'], extra_fields={'gsd': 20.0}),
+        'B8A': pystac.Asset('B8A.tif', media_type='image/tiff', roles=['data'], extra_fields={'gsd': 20.0}),
+        'preview': pystac.Asset('preview.png', media_type='image/png', roles=['thumbnail']),
+        'granule-metadata': pystac.Asset('MTD.xml', media_type='application/xml', roles=['metadata']),
+    }
+
+    assert list(select_assets(assets)) == list(assets)
+    assert list(select_assets(assets, include=['B02', 'B8A'])) == ['B02', 'B8A']
+    assert list(select_assets(assets, include='*metadata*')) == ['granule-metadata']
+    assert list(select_assets(assets, include='metadata')) == ['granule-metadata']
+    assert list(select_assets(assets, exclude=['image/png', 'metadata'])) == ['B02', 'B05', 'B8A']
+    assert list(select_assets(assets, resolutions=20)) == ['B05', 'B8A']
+    assert list(select_assets(assets, include='B02', resolutions=[20], exclude='B05')) == ['B02', 'B8A']
+
+
+def test_expected_checksum():
+    asset = pystac.Asset(href='http://test/B01.tif', extra_fields={'file:checksum': '1220' + 'ab' * 32})
+    assert expected_checksum(asset) == ('sha256', 'ab' * 32)
+
+    # without file:checksum, the MD5 informed by the server (base64) is used
+    asset = pystac.Asset(href='http://test/B01.tif')
+    assert expected_checksum(asset, headers={'Content-MD5': 'AAAAAAAAAAAAAAAAAAAAAA=='}) == ('md5', '00' * 16)
+    assert expected_checksum(asset) is None
+
+
+def test_compact_df_parses_mixed_iso_dates():
+    df = compact_df(pd.DataFrame({'datetime': ['2021-01-01T13:22:31.024000Z', '2021-01-06T13:22:29Z', None]}))
+    assert list(df['datetime'].dt.day[:2]) == [1, 6] and df['datetime'].isna().sum() == 1
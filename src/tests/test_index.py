@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pystac
+import pytest
+
+from downplanet import DownPlanet
+
+
+def make_scene(tile, day, cloud, bbox):
+    item_id = f'S2A_MSIL2A_202101{day:02d}T132231_R038_T{tile}_202101{day:02d}T000000'
+    x_min, y_min, x_max, y_max = bbox
+    geometry = {'type': 'Polygon', 'coordinates': [[[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max],
+                                                    [x_min, y_min]]]}
+    return pystac.Item(id=item_id, geometry=geometry, bbox=bbox, datetime=datetime(2021, 1, day),
+                       properties={'eo:cloud_cover': cloud})
+
+
+def test_search_index():
+    items = [make_scene('22KGA', 1, 30., [0, 0, 1, 1]), make_scene('22KGA', 6, 5., [0, 0, 1, 1]),
+             make_scene('22KGA', 11, 50., [0, 0, 1, 1]), make_scene('22KHA', 1, 10., [1, 0, 2, 1]),
+             make_scene('22KHA', 16, 2., [1, 0, 2, 1])]
+
+    downloader = DownPlanet(catalog=None)
+    downloader.search_df = DownPlanet.items_df(items)
+    index = downloader.search_index
+    assert downloader.search_index is index
+
+    # least cloudy per tile (the tile comes from the ids)
+    best = index.best_per_tile()
+    assert list(best['eo:cloud_cover']) == [5., 2.]
+    assert list(index.best_per_tile(max_cloud=20, n=2)['eo:cloud_cover']) == [5., 2., 10.]
+
+    assert list(index.nearest_in_time('2021-01-10', n=2).index) == [items[2].id, items[1].id]
+    assert list(index.between('2021-01-06', '2021-01-11').index) == [items[1].id, items[2].id]
+
+    # bbox selections
+    assert len(index.covering([(0.2, 0.2), (0.4, 0.2), (0.4, 0.4)])) == 3
+    assert len(index.covering([(0.8, 0.2), (1.2, 0.2), (1.2, 0.4)])) == 5
+    assert len(index.covering([(0.8, 0.2), (1.2, 0.2), (1.2, 0.4)], contains=True)) == 0
+    assert len(index.covering((1.5, 0.5))) == 2
+
+    # a new search_df gets a new index
+    downloader.search_df = DownPlanet.items_df(items[:2])
+    assert len(downloader.search_index) == 2
+
+
+def test_deduplicate():
+    items = [make_scene('22KGA', 1, 30., [0, 0, 1, 1]), make_scene('22KGA', 1, 30., [0, 0, 1, 1]),
+             make_scene('22KHA', 1, 10., [1, 0, 2, 1]), make_scene('22KGA', 6, 5., [0, 0, 1, 1])]
+
+    # the same acquisition processed twice: the newest baseline is kept
+    items[0].properties['s2:processing_baseline'] = '05.00'
+    items[1].properties['s2:processing_baseline'] = '02.14'
+    items[1].id = items[1].id[:-15] + '20210105T000000'
+
+    downloader = DownPlanet(catalog=None)
+    downloader.search_df = DownPlanet.items_df(items)
+    df = downloader.deduplicate()
+
+    assert list(df.index) == [items[0].id, items[2].id, items[3].id]
+    assert downloader.search_df is df
+
+
+def test_deduplicate_covered():
+    pytest.importorskip('shapely')
+
+    items = [make_scene('22KGA', 1, 30., [0, 0, 1, 1]), make_scene('22KHA', 1, 10., [0.5, 0, 0.9, 1]),
+             make_scene('22KHA', 6, 10., [0.5, 0, 0.9, 1]), make_scene('22KHB', 6, 10., [0.6, 0, 0.8, 1])]
+    for item in items:
+        item.collection_id = 'sentinel-2-l2a'
+
+    # a scene of another collection covering the one of day 6
+    landsat = make_scene('22KHC', 6, 10., [0, 0, 2, 2])
+    landsat.collection_id = 'landsat-c2-l2'
+    items.append(landsat)
+
+    downloader = DownPlanet(catalog=None)
+    downloader.search_df = DownPlanet.items_df(items)
+
+    # the partial footprints of the same day and collection are dropped, the one of another day is kept
+    assert list(downloader.deduplicate(covered=True).index) == [items[0].id, items[2].id, landsat.id]
@@ -1,4 +1,12 @@
-from downplanet import DownPlanet
+import hashlib
+
+import pytest
+import requests
+
+from downplanet import DownPlanet, DownloadError
+from downplanet.common import Manifest
+from downplanet.index import shapely
+from tests.conftest import FileHandler, make_item, add_items, serve_stac_api
 
 
 def test_down_planet():
@@ -10,3 +18,468 @@ def test_down_planet():
     # test opening a good connection
     downloader = DownPlanet()
     assert hasattr(downloader, 'catalog')
+
+
+def test_download_parallel_assets(server, downloader, tmp_path):
+    assets = {f'B{i:02d}': bytes([i]) * (1000 * i) for i in range(1, 9)}
+    item = make_item('S2A_TEST', server, assets)
+    add_items(downloader, [item])
+
+    assert downloader.download('S2A_TEST', tmp_path, max_workers=4)
+
+    for name, data in assets.items():
+        assert (tmp_path/'S2A_TEST.PC'/f'{name}.tif').read_bytes() == data
+
+
+def test_download_reports_failed_assets(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100, 'B02': b'2' * 100})
+    add_items(downloader, [item])
+    server.failures['/S2A_TEST/B02.tif'] = [404] * 10
+
+    with pytest.raises(DownloadError) as e:
+        downloader.download('S2A_TEST', tmp_path, max_workers=2)
+
+    assert list(e.value.failed) == ['B02']
+    assert (tmp_path/'S2A_TEST.PC'/'B01.tif').read_bytes() == b'1' * 100
+
+
+def test_download_all_survives_unexpected_errors(server, downloader, tmp_path):
+    add_items(downloader, [make_item(f'S2A_{i}', server, {'B01': b'1' * 10}) for i in range(2)])
+
+    # an invalid clip makes download_item raise, the other images must still have their records
+    results = downloader.download_all(tmp_path, show_pbar=False, workers=2, clip='bad')
+    assert list(results['status']) == ['failed', 'failed'] and results['error'].notna().all()
+
+
+def test_download_all_records(server, downloader, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'x' * 100 * i, 'B02': b'y' * 10}) for i in range(1, 5)]
+    add_items(downloader, items)
+    server.failures['/S2A_3/B02.tif'] = [404] * 10
+
+    results = downloader.download_all(tmp_path, show_pbar=False, retries=1, workers=3, max_connections=2)
+
+    assert list(results.index) == ['S2A_1', 'S2A_2', 'S2A_3', 'S2A_4']
+    assert list(results['status']) == ['done', 'done', 'failed', 'done']
+    assert results.loc['S2A_4', 'bytes'] == 410
+    assert 'B02' in results.loc['S2A_3', 'error']
+
+
+def test_download_retries_only_failed_asset(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100, 'B02': b'2' * 100})
+    add_items(downloader, [item])
+    server.failures['/S2A_TEST/B02.tif'] = [503, 500, 403]
+
+    record = downloader.download_item(item, tmp_path, retries=3, backoff_factor=0.01)
+
+    assert record['status'] == 'done' and record['retries'] == 3
+    gets = [path for method, path, _ in server.requests if method == 'GET']
+    assert gets.count('/S2A_TEST/B01.tif') == 1
+    assert gets.count('/S2A_TEST/B02.tif') == 4
+    assert (tmp_path/'S2A_TEST.PC'/'B02.tif').read_bytes() == b'2' * 100
+
+
+def test_download_does_not_retry_client_errors(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100})
+    server.failures['/S2A_TEST/B01.tif'] = [404] * 10
+
+    record = downloader.download_item(item, tmp_path, retries=3, backoff_factor=0.01)
+
+    assert record['status'] == 'failed' and record['retries'] == 0
+    assert list(record['failed']) == ['B01']
+
+
+def test_download_skips_complete_and_resumes_partial_assets(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 1000, 'B02': bytes(range(256)) * 4})
+    downloader.download_item(item, tmp_path)
+
+    # simulate an interruption in the middle of B02
+    folder = tmp_path/'S2A_TEST.PC'
+    (folder/'B02.tif').rename(folder/'B02.tif.part')
+    with open(folder/'B02.tif.part', 'r+b') as f:
+        f.truncate(300)
+    Manifest(folder).update('B02.tif', part_etag=FileHandler.etag(bytes(range(256)) * 4))
+
+    server.requests.clear()
+    record = downloader.download_item(item, tmp_path)
+
+    assert record['status'] == 'done' and record['bytes'] == 724
+    assert [(path, rng) for method, path, rng in server.requests if method == 'GET'] == \
+           [('/S2A_TEST/B02.tif', 'bytes=300-')]
+    assert (folder/'B02.tif').read_bytes() == bytes(range(256)) * 4
+    assert not (folder/'B02.tif.part').exists()
+
+    # if the asset changes on the server, it is downloaded again
+    server.files['/S2A_TEST/B01.tif'] = b'3' * 500
+    downloader.size_cache.clear()
+    record = downloader.download_item(item, tmp_path)
+    assert record['bytes'] == 500 and (folder/'B01.tif').read_bytes() == b'3' * 500
+
+
+def test_sync_existing_archive(server, downloader, tmp_path):
+    data = {'B01': b'1' * 100, 'B02': b'2' * 200, 'B03': b'3' * 300, 'B04': b'4' * 400}
+    item = make_item('S2A_SYNC', server, data)
+    item.assets['B03'].extra_fields['file:checksum'] = 'd50110' + hashlib.md5(b'3' * 300).hexdigest()
+    add_items(downloader, [item])
+    downloader.download_all(tmp_path, show_pbar=False)
+
+    # an archive without manifest, with a corrupted file, a changed asset and a missing one
+    folder = tmp_path/'S2A_SYNC.PC'
+    (folder/Manifest.file_name).unlink()
+    (folder/'B03.tif').write_bytes(b'x' * 300)
+    server.files['/S2A_SYNC/B02.tif'] = b'5' * 250
+    (folder/'B04.tif').rename(folder/'B04.tif.part')
+    downloader.size_cache.clear()
+
+    server.requests.clear()
+    plan = downloader.download_all(tmp_path, show_pbar=False, dry_run=True)
+    assert plan.set_index('asset')['status'].to_dict() == \
+           {'B01': 'current', 'B02': 'changed', 'B03': 'changed', 'B04': 'missing'}
+    assert plan['bytes'].sum() == 250 + 300 + 400
+    assert not [r for r in server.requests if r[0] == 'GET'] and not (folder/Manifest.file_name).exists()
+
+    results = downloader.download_all(tmp_path, show_pbar=False)
+    assert results.loc['S2A_SYNC', 'bytes'] == 250 + 300 + 400
+    assert sorted(r[1] for r in server.requests if r[0] == 'GET') == \
+           ['/S2A_SYNC/B02.tif', '/S2A_SYNC/B03.tif', '/S2A_SYNC/B04.tif']
+    assert (folder/'B03.tif').read_bytes() == b'3' * 300
+
+    plan = downloader.plan(tmp_path)
+    assert (plan['status'] == 'current').all() and plan['bytes'].sum() == 0
+
+
+def test_download_in_ranges(server, downloader, tmp_path):
+    data = bytes(range(256)) * (4 * 2 ** 12)
+    item = make_item('S2A_PARTS', server, {'B08': data, 'B01': b'small'})
+    add_items(downloader, [item])
+
+    # one of the ranges fails (503), is retried alone and fails for good (404)
+    server.failures['/S2A_PARTS/B08.tif'] = [503, 404]
+    with pytest.raises(DownloadError):
+        downloader.download('S2A_PARTS', tmp_path, parts=4, min_part_size=2 ** 16, backoff_factor=0.01,
+                            max_workers=1)
+
+    ranges = [r[2] for r in server.requests if r[0] == 'GET' and r[1] == '/S2A_PARTS/B08.tif']
+    assert len(ranges) == 5 and set(ranges) == {f'bytes={i * 2 ** 20}-{(i + 1) * 2 ** 20 - 1}' for i in range(4)}
+    assert Manifest(tmp_path/'S2A_PARTS.PC').get('B08.tif')['ranges'] == 4
+
+    # the next download asks just for the missing range
+    server.requests.clear()
+    assert downloader.download('S2A_PARTS', tmp_path, parts=4, min_part_size=2 ** 16)
+    assert len([r for r in server.requests if r[0] == 'GET' and r[1] == '/S2A_PARTS/B08.tif']) == 1
+    assert (tmp_path/'S2A_PARTS.PC'/'B08.tif').read_bytes() == data
+    assert (tmp_path/'S2A_PARTS.PC'/'B01.tif').read_bytes() == b'small'
+    assert Manifest(tmp_path/'S2A_PARTS.PC').get('B08.tif')['ranges'] is None
+
+
+def test_download_in_ranges_falls_back_to_a_single_stream(server, downloader, tmp_path):
+    data = bytes(range(256)) * (4 * 2 ** 12)
+    item = make_item('S2A_PARTS', server, {'B08': data})
+    server.ignore_ranges = True
+
+    record = downloader.download_item(item, tmp_path, parts=4, min_part_size=2 ** 16)
+
+    assert record['status'] == 'done' and record['bytes'] == len(data)
+    assert (tmp_path/'S2A_PARTS.PC'/'B08.tif').read_bytes() == data
+    assert Manifest(tmp_path/'S2A_PARTS.PC').get('B08.tif')['ranges'] is None
+
+
+@pytest.mark.parametrize('parts', [1, 4])
+def test_download_verifies_checksums(server, downloader, tmp_path, parts):
+    data = bytes(range(256)) * (4 * 2 ** 12)
+    item = make_item('S2A_SUM', server, {'B01': data})
+    item.assets['B01'].extra_fields['file:checksum'] = 'd50110' + hashlib.md5(data).hexdigest()
+
+    record = downloader.download_item(item, tmp_path, parts=parts, min_part_size=2 ** 16)
+    assert record['status'] == 'done'
+    assert Manifest(tmp_path/'S2A_SUM.PC').get('B01.tif')['checksum'] == 'md5:' + hashlib.md5(data).hexdigest()
+
+    # a corrupted asset is downloaded again until the retries are exhausted
+    item.assets['B01'].extra_fields['file:checksum'] = '1220' + hashlib.sha256(b'other').hexdigest()
+    server.requests.clear()
+    record = downloader.download_item(item, tmp_path, parts=parts, min_part_size=2 ** 16, overwrite=True,
+                                      retries=2, backoff_factor=0.01)
+
+    assert record['status'] == 'failed' and 'does not match' in record['failed']['B01']
+    assert record['retries'] == 2
+    assert len([r for r in server.requests if r[0] == 'GET']) == 3 * parts
+    assert not (tmp_path/'S2A_SUM.PC'/'B01.tif.part').exists()
+
+    # without verification, the file is accepted
+    record = downloader.download_item(item, tmp_path, parts=parts, min_part_size=2 ** 16, verify=False)
+    assert record['status'] == 'done' and (tmp_path/'S2A_SUM.PC'/'B01.tif').read_bytes() == data
+
+
+def test_download_restarts_files_longer_than_expected(server, downloader, tmp_path):
+    item = make_item('S2A_SIZE', server, {'B01': b'1' * 100})
+    item.assets['B01'].extra_fields['file:size'] = 50
+
+    record = downloader.download_item(item, tmp_path, retries=2, backoff_factor=0.01)
+
+    # every attempt starts from zero, instead of asking for a range past the end
+    assert record['status'] == 'failed' and record['retries'] == 2
+    assert [rng for method, _, rng in server.requests if method == 'GET'] == [None] * 3
+    assert not (tmp_path/'S2A_SIZE.PC'/'B01.tif.part').exists()
+
+
+def test_download_checks_content_md5(server, downloader, tmp_path):
+    item = make_item('S2A_MD5', server, {'B01': b'1' * 100})
+
+    # the server sends a Content-MD5 of other content
+    original = FileHandler.send_header
+
+    def send_header(handler, keyword, value):
+        original(handler, keyword, 'AAAAAAAAAAAAAAAAAAAAAA==' if keyword == 'Content-MD5' else value)
+
+    FileHandler.send_header = send_header
+    try:
+        record = downloader.download_item(item, tmp_path, retries=1, backoff_factor=0.01)
+    finally:
+        FileHandler.send_header = original
+
+    assert record['status'] == 'failed' and 'does not match' in record['failed']['B01']
+    assert downloader.download_item(item, tmp_path)['status'] == 'done'
+
+
+@pytest.mark.parametrize('readinto', [False, True])
+def test_download_asset_chunks(server, downloader, tmp_path, readinto):
+    data = bytes(range(256)) * 1000
+    item = make_item('S2A_TEST', server, {'B01': data})
+
+    written = downloader.download_asset(item.assets['B01'], tmp_path, chunk_size=10000, readinto=readinto,
+                                        fsync=True)
+
+    assert written == len(data)
+    assert (tmp_path/'B01.tif').read_bytes() == data
+
+
+def test_session_is_reused_across_items(server, tmp_path):
+    session = requests.Session()
+    downloader = DownPlanet(catalog=None, session=session)
+    assert downloader.session is session
+
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1' * 100, 'B02': b'2' * 100}) for i in range(3)]
+    add_items(downloader, items)
+    downloader.download_all(tmp_path, show_pbar=False, max_workers=1)
+
+    # 3 items x 2 assets x (HEAD + GET) over a single keep-alive connection
+    assert len(server.requests) == 12
+    assert len(server.clients) == 1
+
+
+def test_download_selected_assets(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100, 'B02': b'2' * 100, 'B03': b'3' * 100})
+
+    record = downloader.download_item(item, tmp_path, include=['B0[12]'], exclude='B01')
+
+    assert record['bytes'] == 100
+    assert sorted(p.name for p in (tmp_path/'S2A_TEST.PC').glob('*.tif')) == ['B02.tif']
+    assert {path for _, path, _ in server.requests} == {'/S2A_TEST/B02.tif'}
+
+
+def test_sign_item_probes(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100, 'B02': b'2' * 200, 'B03': b'3' * 300})
+    item.assets['B03'].extra_fields['file:size'] = 300
+
+    cache = {}
+    signed_item = DownPlanet.sign_item(item, cache=cache)
+    assert signed_item.size == 600
+    assert signed_item.assets['B02'].etag == FileHandler.etag(b'2' * 200)
+    assert sorted(path for method, path, _ in server.requests if method == 'HEAD') == \
+           ['/S2A_TEST/B01.tif', '/S2A_TEST/B02.tif']
+
+    # the second time, the sizes come from the cache
+    server.requests.clear()
+    assert DownPlanet.sign_item(item, cache=cache).size == 600
+    assert not server.requests
+
+    # without probing, the total size is unknown
+    signed_item = DownPlanet.sign_item(item, probe=False)
+    assert signed_item.size is None and signed_item.assets['B03'].size == 300
+    assert not server.requests
+
+    record = downloader.download_item(item, tmp_path, probe=False)
+    assert record['bytes'] == 600 and not [r for r in server.requests if r[0] == 'HEAD']
+
+
+def test_failed_probes_are_not_cached(server, downloader, tmp_path):
+    item = make_item('S2A_TEST', server, {'B01': b'1' * 100})
+    data = server.files.pop('/S2A_TEST/B01.tif')
+
+    # the asset is missing while probing: its size is unknown and the download fails
+    record = downloader.download_item(item, tmp_path, retries=0)
+    assert record['status'] == 'failed' and not downloader.size_cache
+
+    # when it comes back, it is probed again and downloaded
+    server.files['/S2A_TEST/B01.tif'] = data
+    record = downloader.download_item(item, tmp_path)
+    assert record['status'] == 'done' and record['bytes'] == 100
+
+
+def test_download_all_processes(server, downloader, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'x' * 100 * i, 'B02': b'y' * 10}) for i in range(1, 5)]
+    add_items(downloader, items)
+    server.failures['/S2A_3/B02.tif'] = [404] * 10
+
+    results = downloader.download_all(tmp_path, show_pbar=False, executor='process', workers=2)
+
+    assert list(results['status']) == ['done', 'done', 'failed', 'done']
+    assert list(results['bytes']) == [110, 210, 300, 410]
+    assert (tmp_path/'S2A_4.PC'/'B01.tif').read_bytes() == b'x' * 400
+
+
+def test_processes_use_default_assets(server, tmp_path):
+    item = make_item('S2A_1', server, {'B01': b'x' * 100, 'B02': b'y' * 10})
+    item.collection_id = 'test'
+    downloader = DownPlanet(catalog=None, assets={'test': dict(include=['B01'])})
+    add_items(downloader, [item])
+
+    results = downloader.download_all(tmp_path, show_pbar=False, executor='process')
+    assert list(results['bytes']) == [100] and not (tmp_path/'S2A_1.PC'/'B02.tif').exists()
+
+
+def test_iter_search_yields_pages(server):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1' * 10}, properties={'eo:cloud_cover': i}) for i in range(5)]
+    serve_stac_api(server, items, page_size=2)
+    downloader = DownPlanet(catalog=server.url)
+
+    pages = list(downloader.iter_search((-48.4, -23.2), '2021', page_size=2))
+    assert [list(page.index) for page in pages] == [['S2A_0', 'S2A_1'], ['S2A_2', 'S2A_3'], ['S2A_4']]
+
+    downloader.search((-48.4, -23.2), '2021')
+    assert list(downloader.search_df.index) == [f'S2A_{i}' for i in range(5)]
+    assert downloader.get_item('S2A_3').id == 'S2A_3'
+
+
+def test_search_filters_on_server(server):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'}, properties={'eo:cloud_cover': i}) for i in range(5)]
+    serve_stac_api(server, items, page_size=2)
+    downloader = DownPlanet(catalog=server.url)
+
+    query = {'eo:cloud_cover': {'lt': 20}}
+    cql2 = {'op': '=', 'args': [{'property': 's2:mgrs_tile'}, '22KGA']}
+    downloader.search((-48.4, -23.2), '2021', query=query, filter=cql2, fields=['id', 'properties.eo:cloud_cover'],
+                      max_items=3, page_size=2)
+
+    body = server.bodies[0]
+    assert body['query'] == query and body['filter'] == cql2 and body['limit'] == 2
+    assert body['fields'] == {'include': ['id', 'properties.eo:cloud_cover'], 'exclude': []}
+    assert list(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2']
+
+
+def test_search_several_collections(server, tmp_path):
+    s2 = [make_item(f'S2A_{i}', server, {'B01': b'1', 'preview': b'p'}) for i in range(3)]
+    dem = [make_item(f'DEM_{i}', server, {'data': b'd' * 10, 'rendered_preview': b'p'}) for i in range(2)]
+    for item in s2:
+        item.collection_id = 'sentinel-2-l2a'
+    for item in dem:
+        item.collection_id = 'cop-dem-glo-30'
+
+    serve_stac_api(server, s2, page_size=2, collection='sentinel-2-l2a')
+    serve_stac_api(server, dem, page_size=1, collection='cop-dem-glo-30')
+    downloader = DownPlanet(catalog=server.url, collections=['sentinel-2-l2a', 'cop-dem-glo-30'])
+
+    downloader.search((-48.4, -23.2), '2021')
+    assert sorted(downloader.search_df.index) == ['DEM_0', 'DEM_1', 'S2A_0', 'S2A_1', 'S2A_2']
+    assert downloader.search_df.loc['DEM_1', 'collection'] == 'cop-dem-glo-30'
+    assert sorted(body['collections'][0] for body in server.bodies) == ['cop-dem-glo-30', 'sentinel-2-l2a']
+
+    # each collection has its default assets
+    downloader.download_all(tmp_path, show_pbar=False)
+    assert sorted(p.name for p in (tmp_path/'DEM_0.PC').glob('*.tif')) == ['data.tif']
+    assert sorted(p.name for p in (tmp_path/'S2A_0.PC').glob('*.tif')) == ['B01.tif', 'preview.tif']
+
+
+def test_search_many_aois(server):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'}) for i in range(4)]
+    for item, (x_min, y_min, x_max, y_max) in zip(items, [(0, 0, 1, 1), (1, 0, 2, 1), (10, 0, 11, 1),
+                                                          (1.1, 0.7, 1.2, 0.8)]):
+        item.bbox = [x_min, y_min, x_max, y_max]
+        item.geometry = {'type': 'Polygon', 'coordinates': [[[x_min, y_min], [x_max, y_min], [x_max, y_max],
+                                                             [x_min, y_max], [x_min, y_min]]]}
+
+    # an L-shaped footprint, whose bbox contains the AOI 'd' but the footprint does not
+    edge = make_item('S2A_4', server, {'B01': b'1'})
+    edge.bbox = [10, 0, 11, 1]
+    edge.geometry = {'type': 'Polygon', 'coordinates': [[[10, 0], [10.2, 0], [10.2, 0.8], [11, 0.8], [11, 1],
+                                                         [10, 1], [10, 0]]]}
+    items.append(edge)
+
+    serve_stac_api(server, items, page_size=2)
+    downloader = DownPlanet(catalog=server.url)
+
+    aois = {'a': (0.5, 0.5), 'b': [(0.6, 0.6), (0.9, 0.6), (0.9, 0.9)], 'c': (1.5, 0.5), 'd': (10.5, 0.5)}
+    aoi_items = downloader.search_many(aois, '2021', max_size=2.)
+
+    # the three AOIs around x=1 are searched together and the same results are kept once.
+    # S2A_3 is inside the box of that search, but outside every AOI
+    assert len(server.bodies) == 2
+    assert aoi_items['a'] == ['S2A_0'] and aoi_items['b'] == ['S2A_0'] and aoi_items['c'] == ['S2A_1']
+
+    # with shapely, the footprints are tested. Otherwise, just the bboxes
+    if shapely is not None:
+        assert aoi_items['d'] == ['S2A_2']
+        assert sorted(downloader.search_df.index) == ['S2A_0', 'S2A_1', 'S2A_2']
+    else:
+        assert aoi_items['d'] == ['S2A_2', 'S2A_4']
+
+
+def test_items_df_is_compact(server):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1'},
+                       properties={'eo:cloud_cover': i + 0.5, 's2:mgrs_tile': '22KGA', 'platform': 'Sentinel-2A',
+                                   'updated': f'2021-02-0{i + 1}T00:00:00Z', 'instruments': ['msi']})
+             for i in range(4)]
+
+    df = DownPlanet.items_df(items)
+    assert df['datetime'].dtype.kind == 'M'
+    assert df['updated'].dtype.kind == 'M'
+    assert df['eo:cloud_cover'].dtype == 'float32'
+    assert df['s2:mgrs_tile'].dtype == 'category'
+    assert df.loc['S2A_1', 'instruments'] == ['msi']
+
+    # the items are rehydrated on demand
+    downloader = DownPlanet(catalog=None)
+    downloader.search_df = df
+    item = downloader.get_item('S2A_2')
+    assert item.id == 'S2A_2' and item.properties['eo:cloud_cover'] == 2.5
+    assert item.assets['B01'].href == items[2].assets['B01'].href
+
+    # just the selected properties are kept
+    df = DownPlanet.items_df(items, properties=['eo:cloud_cover', 'missing'])
+    assert list(df.columns) == ['eo:cloud_cover', 'missing', 'collection', 'item']
+
+
+def test_download_search(server, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1' * 10 * i}) for i in range(5)]
+    serve_stac_api(server, items, page_size=2)
+    downloader = DownPlanet(catalog=server.url)
+
+    results = downloader.download_search(tmp_path, (-48.4, -23.2), '2021', page_size=2, show_pbar=False, workers=2)
+
+    assert list(results.index) == [f'S2A_{i}' for i in range(5)]
+    assert list(results['bytes']) == [0, 10, 20, 30, 40]
+    assert (results['status'] == 'done').all()
+
+
+def test_download_search_pipeline_with_small_queues(server, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1' * 10 * i, 'B02': b'2'}) for i in range(7)]
+    serve_stac_api(server, items, page_size=3)
+    downloader = DownPlanet(catalog=server.url)
+
+    results = downloader.download_search(tmp_path, (-48.4, -23.2), '2021', page_size=3, show_pbar=False,
+                                         workers=2, sign_workers=2, queue_size=1, include='B01')
+
+    assert list(results['bytes']) == [10 * i for i in range(7)]
+    assert not list(tmp_path.glob('*/B02.tif'))
+
+
+def test_download_search_survives_failed_downloads(server, tmp_path):
+    items = [make_item(f'S2A_{i}', server, {'B01': b'1' * 10}) for i in range(4)]
+    serve_stac_api(server, items, page_size=2)
+    downloader = DownPlanet(catalog=server.url)
+
+    # an invalid clip makes every download_item raise. The pipeline must not hang with full queues
+    results = downloader.download_search(tmp_path, (-48.4, -23.2), '2021', page_size=2, show_pbar=False,
+                                         workers=1, sign_workers=1, queue_size=1, clip='bad')
+
+    assert list(results.index) == [f'S2A_{i}' for i in range(4)]
+    assert (results['status'] == 'failed').all() and results['error'].notna().all()
@@ -0,0 +1,62 @@
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from downplanet.tokens import TokenCache
+
+
+@pytest.fixture
+def token_server(server, monkeypatch):
+    settings = SimpleNamespace(sas_url=server.url + '/token', subscription_key=None)
+    monkeypatch.setattr('downplanet.tokens.Settings.get', lambda: settings)
+
+    def set_token(token, minutes):
+        expiry = (datetime.now(timezone.utc) + timedelta(minutes=minutes)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        server.files['/token/account/container'] = json.dumps({'msft:expiry': expiry, 'token': token}).encode()
+
+    server.set_token = set_token
+    return server
+
+
+def test_token_cache(token_server):
+    href = 'https://account.blob.core.windows.net/container/S2A/B01.tif'
+    tokens = TokenCache(margin=600)
+
+    token_server.set_token('st=1&se=1&sp=r&sig=a', minutes=60)
+    assert tokens.sign(href) == href + '?st=1&se=1&sp=r&sig=a'
+    assert tokens.sign(href.replace('B01', 'B02')).endswith('B02.tif?st=1&se=1&sp=r&sig=a')
+    assert len(token_server.requests) == 1
+
+    # hrefs outside the blob storage or already signed are not changed
+    assert tokens.sign('http://localhost/B01.tif') == 'http://localhost/B01.tif'
+    assert tokens.sign(href + '?st=0&se=0&sp=r&sig=z') == href + '?st=0&se=0&sp=r&sig=z'
+
+    # a rejected token is renewed just once
+    token_server.set_token('st=2&se=2&sp=r&sig=b', minutes=60)
+    assert tokens.sign(href + '?st=1&se=1&sp=r&sig=a', refresh=True) == href + '?st=2&se=2&sp=r&sig=b'
+    assert tokens.sign(href + '?st=1&se=1&sp=r&sig=a', refresh=True) == href + '?st=2&se=2&sp=r&sig=b'
+    assert len(token_server.requests) == 2
+
+    # a token about to expire is renewed in advance
+    tokens.margin = 2 * 3600
+    token_server.set_token('st=3&se=3&sp=r&sig=c', minutes=60)
+    assert tokens.sign(href) == href + '?st=3&se=3&sp=r&sig=c'
+    assert len(token_server.requests) == 3
+
+
+def test_token_request_is_retried(token_server):
+    href = 'https://account.blob.core.windows.net/container/S2A/B01.tif'
+    token_server.set_token('st=1&se=1&sp=r&sig=a', minutes=60)
+    token_server.failures['/token/account/container'] = [503, 429]
+
+    tokens = TokenCache(backoff_factor=0.01)
+    assert tokens.sign(href) == href + '?st=1&se=1&sp=r&sig=a'
+    assert len(token_server.requests) == 3
+
+    # other client errors are not retried
+    token_server.failures['/token/account/container'] = [401]
+    with pytest.raises(requests.HTTPError):
+        TokenCache(backoff_factor=0.01).sign(href)